@@ -0,0 +1,334 @@
+#
+#   aggregates.py - Contains the CityAggregates class that keeps running counts
+#   and totals of bikeshare data so statistics can be computed without keeping
+#   every trip in memory.
+#
+
+import numpy as np
+import pandas as pd
+import calendar as cal
+from sketches import HeavyHitters, LogHistogram
+
+
+class CityAggregates:
+    '''
+    A class for accumulating counts and totals of bikeshare data by month,
+    weekday and hour. Converted data is folded in one chunk at a time and two
+    CityAggregates objects can be merged.
+    '''
+
+    _month_names = cal.month_name[1:]
+    _weekday_names = list(cal.day_name)
+
+    # Columns whose value counts are kept for every month and weekday
+    _count_cols = ['Start Station', 'End Station', 'User Type', 'Gender',
+                   'Birth Year']
+
+    # Columns that are summarized by HeavyHitters sketches instead of exact
+    # counts when an error bound is given
+    _sketch_cols = ['Start Station', 'End Station', 'Trip']
+
+    # Rows folded in at a time by from_dataframe when an error bound is given,
+    # so that the exact counts handed to the sketches stay small
+    _sketch_chunk_rows = 100000
+
+    def __init__(self, error_bound=None):
+        '''
+        Initialize empty trip counts, duration totals and duration histograms
+        for every month, weekday and hour, and empty value counts for every
+        counted column.
+
+        Parameters
+
+            error_bound: If given, stations and trips are counted approximately
+                         with one HeavyHitters sketch per month and weekday,
+                         which keeps memory bounded no matter how many distinct
+                         trips there are. Counts are then at most error_bound
+                         times the number of trips too low.
+        '''
+        cube_shape = (len(self._month_names), len(self._weekday_names), 24)
+        self._trip_counts = np.zeros(cube_shape, dtype='int64')
+        self._duration_counts = np.zeros(cube_shape, dtype='int64')
+        self._duration_sums = np.zeros(cube_shape, dtype='float64')
+        # Log-bucket histogram counts of the trip durations of every cell, in
+        # the buckets of an empty LogHistogram
+        self._histogram = LogHistogram()
+        self._duration_buckets = np.zeros(
+                cube_shape + (self._histogram.num_buckets,), dtype='int64')
+        self._value_counts = {}
+        self._count_arrays = {}
+        self._error_bound = error_bound
+        self._sketches = {}
+
+    @classmethod
+    def from_dataframe(cls, city_data, error_bound=None):
+        '''
+        Return a CityAggregates object built from all of a city's converted
+        data in one pass. With an error bound, the data is folded in one
+        chunk of rows at a time, so memory use doesn't grow with the number
+        of distinct trips.
+
+        Parameters
+
+            city_data: Dataframe with the columns produced by CsvData.
+
+            error_bound: Error bound of approximate station and trip counts,
+                         or None to count them exactly.
+        '''
+        aggregates = cls(error_bound)
+        if error_bound is None:
+            aggregates.update(city_data)
+            return aggregates
+
+        columns = list(city_data.columns)
+        for start in range(0, len(city_data), cls._sketch_chunk_rows):
+            stop = start + cls._sketch_chunk_rows
+            aggregates.update(pd.DataFrame(
+                    {col: city_data[col].iloc[start:stop].reset_index(
+                            drop=True) for col in columns}))
+        return aggregates
+
+    @property
+    def columns(self):
+        '''
+        Names of the columns that statistics can be computed for.
+        '''
+        return ['Month', 'Weekday', 'Hour', 'Trip Duration',
+                *self._value_counts, *self._sketches]
+
+    @property
+    def error_bound(self):
+        '''
+        Error bound of the approximate station and trip counts, or None if
+        they are counted exactly.
+        '''
+        return self._error_bound
+
+    def _group_counts(self, cells, codes, labels):
+        '''
+        Helper method to count how often each code occurs in each month and
+        weekday cell. Codes of -1 are missing values and are skipped. Returns
+        a series indexed by month code, weekday code and the label levels.
+        '''
+        valid = codes >= 0
+        num_labels = max(len(labels[0]), 1)
+        keys = cells[valid] * num_labels + codes[valid]
+        keys, counts = np.unique(keys, return_counts=True)
+        cells, codes = np.divmod(keys, num_labels)
+
+        levels = [cells // len(self._weekday_names),
+                  cells % len(self._weekday_names)]
+        levels.extend(np.asarray(label)[codes] for label in labels)
+        return pd.Series(counts, index=pd.MultiIndex.from_arrays(levels))
+
+    def _add_counts(self, col, counts):
+        '''
+        Helper method to add value counts to the running totals of a column.
+        Approximately counted columns add them to the sketch of each month and
+        weekday cell instead.
+        '''
+        if self._error_bound and col in self._sketch_cols:
+            sketches = self._sketches.setdefault(col, {})
+            for cell, cell_counts in counts.groupby(level=[0, 1]):
+                if cell not in sketches:
+                    sketches[cell] = HeavyHitters(self._error_bound)
+                sketches[cell].update(cell_counts.droplevel([0, 1]))
+            return
+
+        if col in self._value_counts:
+            counts = self._value_counts[col].add(counts, fill_value=0)
+        self._value_counts[col] = counts.astype('int64')
+        self._count_arrays.pop(col, None)
+
+    def _get_count_arrays(self, col):
+        '''
+        Helper method to get the value counts of a column as flat arrays sorted
+        by month and weekday cell: cell offsets, label codes, the labels and
+        the counts. The arrays are built on first use after an update.
+        '''
+        if col not in self._count_arrays:
+            counts = self._value_counts[col].sort_index()
+            index = counts.index
+            cells = (index.get_level_values(0).to_numpy('int64') *
+                     len(self._weekday_names) +
+                     index.get_level_values(1).to_numpy('int64'))
+            offsets = np.searchsorted(cells,
+                                      np.arange(self._trip_counts[..., 0].size
+                                                + 1))
+            label_codes, labels = pd.factorize(index.droplevel([0, 1]))
+            self._count_arrays[col] = (offsets, label_codes, labels,
+                                       counts.to_numpy())
+        return self._count_arrays[col]
+
+    def update(self, city_data):
+        '''
+        Fold a chunk of converted city data into the running totals.
+
+        Parameters
+
+            city_data: Dataframe with the columns produced by CsvData, e.g. one
+                       chunk of a csv file.
+        '''
+        months = city_data['Month'].cat.codes.to_numpy('int64')
+        weekdays = city_data['Weekday'].cat.codes.to_numpy('int64')
+        hours = city_data['Hour'].to_numpy('int64')
+        cells = months * len(self._weekday_names) + weekdays
+
+        # Trip counts and duration totals for every month, weekday and hour
+        hour_cells = cells * 24 + hours
+        cube_size = self._trip_counts.size
+        cube_shape = self._trip_counts.shape
+        self._trip_counts += np.bincount(
+                hour_cells, minlength=cube_size).reshape(cube_shape)
+
+        durations = city_data['Trip Duration'].to_numpy('float64')
+        has_duration = ~np.isnan(durations)
+        self._duration_counts += np.bincount(
+                hour_cells[has_duration],
+                minlength=cube_size).reshape(cube_shape)
+        self._duration_sums += np.bincount(
+                hour_cells[has_duration], weights=durations[has_duration],
+                minlength=cube_size).reshape(cube_shape)
+
+        num_buckets = self._histogram.num_buckets
+        buckets = self._histogram.buckets(durations[has_duration])
+        self._duration_buckets += np.bincount(
+                hour_cells[has_duration] * num_buckets + buckets,
+                minlength=cube_size * num_buckets).reshape(
+                        self._duration_buckets.shape)
+
+        # Value counts for every month and weekday
+        for col in self._count_cols:
+            if col in city_data.columns:
+                codes, labels = pd.factorize(city_data[col])
+                self._add_counts(col, self._group_counts(cells, codes,
+                                                         [labels]))
+
+        # Trips are counted by start and end station names so that chunks
+        # with different station dictionaries can be combined
+        station_names = city_data['Start Station'].cat.categories
+        trip_codes = city_data['Trip'].to_numpy('int64')
+        codes, trips = pd.factorize(trip_codes)
+        codes[trips[codes] < 0] = -1
+        start_codes, end_codes = np.divmod(trips, max(len(station_names), 1))
+        self._add_counts('Trip', self._group_counts(
+                cells, codes, [station_names[start_codes],
+                               station_names[end_codes]]))
+
+    def merge(self, other):
+        '''
+        Add the totals of another CityAggregates object to this one.
+
+        Parameters
+
+            other: CityAggregates object, e.g. built from another chunk or by
+                   another process.
+        '''
+        self._trip_counts += other._trip_counts
+        self._duration_counts += other._duration_counts
+        self._duration_sums += other._duration_sums
+        self._duration_buckets += other._duration_buckets
+        for col, counts in other._value_counts.items():
+            self._add_counts(col, counts)
+        for col, other_sketches in other._sketches.items():
+            sketches = self._sketches.setdefault(col, {})
+            for cell, sketch in other_sketches.items():
+                if cell not in sketches:
+                    sketches[cell] = HeavyHitters(sketch.error_bound)
+                sketches[cell].merge(sketch)
+
+    def _cell_mask(self, filter_mode, filter_by):
+        '''
+        Helper method to get a boolean month by weekday array that is True for
+        the cells selected by the filter.
+        '''
+        mask = np.zeros(self._trip_counts.shape[:2], dtype=bool)
+        if filter_mode == 'm':
+            mask[self._month_names.index(filter_by), :] = True
+        elif filter_mode == 'd':
+            month, weekday = filter_by
+            mask[self._month_names.index(month),
+                 self._weekday_names.index(weekday)] = True
+        else:
+            mask[:, :] = True
+        return mask
+
+    def value_counts(self, col, filter_mode=None, filter_by=None):
+        '''
+        Return the value counts of a column for the given filter.
+
+        Parameters
+
+            col: Name of one of the counted columns, 'Trip', or one of the
+                 calendar columns 'Month', 'Weekday' and 'Hour'.
+
+            filter_mode: 'm' for month, 'd' for day, or None to forgo filtering.
+
+            filter_by: Name of month or list containing name of month and
+                       weekday depending on the filter mode.
+
+        Returns
+
+            counts: Series of counts indexed by value. Trips are indexed by
+                    start and end station.
+        '''
+        mask = self._cell_mask(filter_mode, filter_by)
+
+        # Calendar columns come straight from the trip count cube
+        if col in ['Month', 'Weekday', 'Hour']:
+            cube = self._trip_counts * mask[:, :, np.newaxis]
+            if col == 'Month':
+                return pd.Series(cube.sum(axis=(1, 2)),
+                                 index=self._month_names)
+            elif col == 'Weekday':
+                return pd.Series(cube.sum(axis=(0, 2)),
+                                 index=self._weekday_names)
+            return pd.Series(cube.sum(axis=(0, 1)), index=range(24))
+
+        # Approximate counts come from merging the sketches of the cells
+        if col in self._sketches:
+            merged = HeavyHitters(self._error_bound)
+            merged.merge(*[sketch for cell, sketch
+                           in self._sketches[col].items() if mask[cell]])
+            return merged.counts()
+
+        # Cells are numbered month by month, so every filter selects one run of
+        # consecutive cells and therefore one slice of the sorted counts
+        offsets, label_codes, labels, counts = self._get_count_arrays(col)
+        cells = np.flatnonzero(mask)
+        start, stop = offsets[cells[0]], offsets[cells[-1] + 1]
+        counts = np.bincount(label_codes[start:stop],
+                             weights=counts[start:stop],
+                             minlength=len(labels))
+        return pd.Series(counts.astype('int64'), index=labels)
+
+    def trip_counts(self):
+        '''
+        Return a dataframe with the number of trips in every month (rows) and
+        weekday (columns).
+        '''
+        return pd.DataFrame(self._trip_counts.sum(axis=2),
+                            index=self._month_names,
+                            columns=self._weekday_names)
+
+    def duration_totals(self, filter_mode=None, filter_by=None):
+        '''
+        Return the total and mean trip duration in seconds for the given
+        filter.
+        '''
+        mask = self._cell_mask(filter_mode, filter_by)
+        sec_sum = self._duration_sums[mask].sum()
+        num_trips = self._duration_counts[mask].sum()
+        sec_mean = sec_sum / num_trips if num_trips else float('nan')
+        return sec_sum, sec_mean
+
+    def duration_histogram(self, filter_mode=None, filter_by=None):
+        '''
+        Return a LogHistogram of the trip durations in seconds for the given
+        filter, merged from the histograms of the selected cells.
+        '''
+        mask = self._cell_mask(filter_mode, filter_by)
+
+        # Merging the histograms of the cells adds up their bucket counts
+        return LogHistogram(bucket_counts=self._duration_buckets[mask]
+                            .sum(axis=(0, 1)))
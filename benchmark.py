@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+#   benchmark.py - times loading the csv files and computing every statistic
+#   for each filter mode, and saves the results so later versions can be
+#   compared against them.
+#
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from csv_data import CsvData
+from data_stats import DataStats
+from synthetic_data import write_city_csvs
+
+# Statistic methods of DataStats that are timed
+stat_methods = ['popular_start_time', 'trip_duration', 'duration_distribution',
+                'popular_stations', 'popular_trip', 'counts_gender',
+                'counts_user', 'birth_years', 'all_stats']
+
+
+def measure(func, repeat):
+    '''
+    Call func once while tracing memory allocations, then repeat more times
+    without tracing. Returns the best wall time in seconds of the untraced
+    calls and the peak memory in MB allocated by the first call.
+    '''
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, peak / 2**20
+
+
+def filter_options(filter_mode, month, weekday):
+    '''
+    Return the filter components passed to the statistic methods for a
+    filter mode.
+    '''
+    if filter_mode == 'm':
+        return month
+    elif filter_mode == 'd':
+        return [month, weekday]
+    return None
+
+
+def run_benchmarks(repeat, month, weekday, precompute=False):
+    '''
+    Time the csv loader and the statistics for every city in the current
+    directory. Returns a list of dictionaries, one per benchmark.
+    '''
+    results = []
+
+    def record(benchmark, city, filter_mode, func):
+        seconds, peak_mb = measure(func, repeat)
+        results.append({'benchmark': benchmark, 'city': city,
+                        'filter_mode': filter_mode or 'none',
+                        'seconds': seconds, 'peak_mb': peak_mb})
+        print("{:<20} {:<15} {:<5} {:10.4f} s {:10.1f} MB".format(
+                benchmark, city, filter_mode or 'none', seconds, peak_mb))
+        sys.stdout.flush()
+
+    # Without a cache, every city is converted from its csv files each time
+    csv_data = CsvData()
+    all_city_data = {}
+    for city in csv_data.get_city_names():
+        record('load', city, None, lambda: csv_data.get_data(city))
+        all_city_data[city] = csv_data.get_data(city)
+
+    # Results aren't cached so that every call does the full computation
+    data_stats = DataStats(all_city_data, precompute=precompute,
+                           cache_size=0)
+    for city in all_city_data:
+        for filter_mode in [None, 'm', 'd']:
+            filter_by = filter_options(filter_mode, month, weekday)
+
+            # Selecting the rows is timed on its own. The statistics are then
+            # timed on one QueryPlan, so a column taken for one statistic is
+            # reused by the next, as in all_stats
+            record('query', city, filter_mode,
+                   lambda: data_stats.query(city, filter_mode, filter_by))
+            query = data_stats.query(city, filter_mode, filter_by)
+
+            for stat_method in stat_methods:
+                record(stat_method, city, filter_mode,
+                       lambda: getattr(data_stats, stat_method)(query))
+
+    return results
+
+
+def compare_results(results, baseline):
+    '''
+    Print the ratio of the baseline time to the current time for every
+    benchmark that is in both, so values above 1 are speedups.
+    '''
+    def key(result):
+        return result['benchmark'], result['city'], result['filter_mode']
+
+    old_results = {key(result): result for result in baseline['results']}
+    print("\nCompared to baseline from {}:".format(
+            baseline['meta'].get('created', 'unknown')))
+    for result in results:
+        old = old_results.get(key(result))
+        if old:
+            print("{:<20} {:<15} {:<5} {:6.2f}x time {:6.2f}x memory".format(
+                    *key(result), old['seconds'] / result['seconds'],
+                    old['peak_mb'] / max(result['peak_mb'], 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Time loading and querying bike share data.")
+    parser.add_argument('--data-dir',
+                        help="directory with the city csv files; synthetic "
+                             "files are written to it if it has none "
+                             "(default: a temporary directory)")
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="trips per city in the synthetic csv files")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per benchmark; the best is reported")
+    parser.add_argument('--month', default='March',
+                        help="month used for the month and day filters")
+    parser.add_argument('--weekday', default='Wednesday',
+                        help="weekday used for the day filter")
+    parser.add_argument('--precompute', action='store_true',
+                        help="answer queries from precomputed aggregates")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the results to FILE as JSON")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare the results to a file written by --save")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = os.path.abspath(args.data_dir or tmp_dir)
+        os.makedirs(data_dir, exist_ok=True)
+        if not any(f.endswith('.csv') for f in os.listdir(data_dir)):
+            print("Writing {:,} rows per city to {}".format(args.rows,
+                                                            data_dir))
+            write_city_csvs(data_dir, args.rows)
+
+        # CsvData reads the csv files in the current directory
+        cwd = os.getcwd()
+        os.chdir(data_dir)
+        try:
+            results = run_benchmarks(args.repeat, args.month, args.weekday,
+                                     args.precompute)
+        finally:
+            os.chdir(cwd)
+
+    if baseline:
+        compare_results(results, baseline)
+
+    if args.save:
+        meta = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'repeat': args.repeat,
+                'precompute': args.precompute}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
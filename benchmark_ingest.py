@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+#   benchmark_ingest.py - compares the schema-driven csv loader in CsvData
+#   against the previous loader on a large csv file.
+#
+
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import calendar as cal
+from csv_data import CsvData
+from synthetic_data import write_city_csv
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def previous_loader(csv_file):
+    '''
+    The loader CsvData used before the schema-driven path: one read for the
+    headers, one read with inferred dtypes and date format, and the derived
+    columns built afterwards. The trips are sorted by start time at the
+    end, as CsvData sorts them, so both loaders do the same work.
+    '''
+    headers = []
+    for col in pd.read_csv(csv_file, nrows=1).columns:
+        if 'unnamed' not in col.lower() and col != 'End Time':
+            headers.append(col)
+
+    category_cols = ['Start Station', 'End Station', 'User Type', 'Gender']
+    dtypes = {col: 'category' for col in category_cols if col in headers}
+    city_data = pd.read_csv(csv_file,
+                            usecols=headers,
+                            dtype=dtypes,
+                            parse_dates=['Start Time'])
+
+    station_names = city_data['Start Station'].cat.categories.union(
+            city_data['End Station'].cat.categories)
+    station_type = pd.CategoricalDtype(station_names)
+    for col in ['Start Station', 'End Station']:
+        city_data[col] = city_data[col].astype(station_type)
+    if 'Birth Year' in city_data:
+        city_data['Birth Year'] = city_data['Birth Year'].astype('Int16')
+
+    start_time = city_data['Start Time'].dt
+    city_data['Month'] = pd.Categorical.from_codes(
+            start_time.month.to_numpy('int8') - 1,
+            categories=cal.month_name[1:], ordered=True)
+    city_data['Weekday'] = pd.Categorical.from_codes(
+            start_time.weekday.to_numpy('int8'),
+            categories=list(cal.day_name), ordered=True)
+    city_data['Hour'] = start_time.hour.to_numpy('int8')
+
+    start_codes = city_data['Start Station'].cat.codes.to_numpy('int32')
+    end_codes = city_data['End Station'].cat.codes.to_numpy('int32')
+    city_data['Trip'] = start_codes * len(station_names) + end_codes
+    city_data['Start Time'] = city_data['Start Time'].to_numpy(
+            'datetime64[s]').astype('int64').astype('uint32')
+
+    start_time = city_data['Start Time'].to_numpy()
+    if (start_time[1:] < start_time[:-1]).any():
+        order = np.argsort(start_time, kind='stable')
+        city_data = city_data.take(order).reset_index(drop=True)
+    return city_data
+
+
+def time_loader(load, csv_file, repeat):
+    '''
+    Return the best wall time in seconds of a loader over several runs.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(csv_file)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Compare csv loaders on a large csv file.")
+    parser.add_argument('--rows', type=int, default=2000000,
+                        help="rows in the generated csv file")
+    parser.add_argument('--csv', help="existing csv file to load instead of "
+                                      "generating one")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per loader; the best time is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = args.csv
+        if not csv_file:
+            csv_file = os.path.join(tmp_dir, 'chicago.csv')
+            print("Writing {:,} rows to {}".format(args.rows, csv_file))
+            write_city_csv(csv_file, args.rows)
+
+        loaders = [('previous loader', previous_loader),
+                   ('schema, c engine', CsvData(engine='c'))]
+        if pyarrow:
+            loaders.append(('schema, pyarrow engine',
+                            CsvData(engine='pyarrow')))
+
+        baseline = None
+        for name, loader in loaders:
+            if isinstance(loader, CsvData):
+                loader = loader._convert_to_dataframe
+            seconds = time_loader(loader, csv_file, args.repeat)
+            if baseline is None:
+                baseline = seconds
+            print("{:<24} {:8.2f} s  {:5.2f}x".format(name, seconds,
+                                                      baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,22 +4,172 @@
 #   three U.S. cities.
 #
 
+import os
+import sys
+import argparse
 from csv_data import CsvData
+from data_cache import DataCache
+from column_store import ColumnStore
 from data_stats import DataStats
 from validate import Validate
 from pretty_print import PrettyPrint
+from profiling import Profiler
+from query_server import QueryServer
 import bikeshare_functions as bike_funs
 
+# Command line options
+parser = argparse.ArgumentParser(
+        description="Interactively explore bike share data.")
+parser.add_argument('--no-cache', action='store_true',
+                    help="don't read or write the converted data cache")
+parser.add_argument('--rebuild-cache', action='store_true',
+                    help="convert every csv file again and refresh the cache")
+parser.add_argument('--cache-dir',
+                    help="directory for the converted data cache (default: "
+                         ".bikeshare_cache, or .bikeshare_columns with "
+                         "--column-store)")
+parser.add_argument('--column-store', action='store_true',
+                    help="cache the converted columns as .npy files that are "
+                         "memory-mapped on use, so startup doesn't depend on "
+                         "the size of the data")
+parser.add_argument('--csv-engine', choices=['c', 'pyarrow'], default='c',
+                    help="parser used for the csv files (pyarrow must be "
+                         "installed to use it)")
+parser.add_argument('--chunksize', type=int,
+                    help="read csv files in chunks of this many rows and keep "
+                         "only aggregated counts, for data that doesn't fit "
+                         "in memory")
+parser.add_argument('--precompute', action='store_true',
+                    help="aggregate each city once when it is loaded and "
+                         "answer every query from the aggregates")
+parser.add_argument('--approximate', type=float, metavar='ERROR',
+                    help="count stations and trips with bounded memory, "
+                         "allowing counts to be off by at most ERROR times "
+                         "the number of trips (e.g. 0.001); implies "
+                         "--precompute unless --chunksize is given")
+parser.add_argument('--result-cache-size', type=int, default=128,
+                    help="number of computed statistics to remember (0 turns "
+                         "the result cache off)")
+parser.add_argument('--batch', metavar='QUERIES',
+                    help="don't prompt; instead compute the statistics for "
+                         "the queries in the file QUERIES, one "
+                         "'City[,Month[,Weekday]]' per line, or for every "
+                         "city, month and weekday if QUERIES is 'all'")
+parser.add_argument('--output', metavar='FILE',
+                    help="file the batch report is written to (default: "
+                         "standard output)")
+parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl',
+                    help="format of the batch report")
+parser.add_argument('--serve', type=int, metavar='PORT',
+                    help="don't prompt; instead keep the data loaded and "
+                         "answer queries as JSON over HTTP on PORT")
+parser.add_argument('--host', default='127.0.0.1',
+                    help="address the server listens on (default: "
+                         "127.0.0.1, i.e. this machine only)")
+parser.add_argument('--threads', type=int, default=8,
+                    help="number of threads answering server requests")
+parser.add_argument('--warm', action='store_true',
+                    help="load every city in a background thread right "
+                         "after startup instead of each city on first use")
+parser.add_argument('--workers', type=int,
+                    help="load all cities up front in this many worker "
+                         "processes instead of loading each city on first use")
+parser.add_argument('--top', type=int, metavar='K',
+                    help="also show tables of the K most popular stations "
+                         "and trips")
+parser.add_argument('--profile', action='store_true',
+                    help="print the time spent in each stage of every query "
+                         "(also turned on by the BIKESHARE_PROFILE "
+                         "environment variable)")
+parser.add_argument('--profile-dump', metavar='DIR',
+                    help="also write a cProfile dump of every query to DIR "
+                         "(or set BIKESHARE_PROFILE_DUMP)")
+args = parser.parse_args()
+if args.approximate is not None and not 0 < args.approximate < 1:
+    parser.error("--approximate must be between 0 and 1")
+
 # Init all objects
-print("Initializing program. Please wait.\n")
-bikeshare_data = CsvData()
-bikeshare_stats = DataStats(bikeshare_data.get_data())
+if not (args.batch or args.serve):
+    print("Initializing program. Please wait.\n")
+profile_dump = args.profile_dump or os.environ.get('BIKESHARE_PROFILE_DUMP')
+profiler = Profiler(args.profile or bool(os.environ.get('BIKESHARE_PROFILE'))
+                    or bool(profile_dump), profile_dump)
+profiler.start_query()
+cache = None
+if not args.no_cache:
+    cache_type = ColumnStore if args.column_store else DataCache
+    cache_options = {'cache_dir': args.cache_dir} if args.cache_dir else {}
+    cache = cache_type(rebuild=args.rebuild_cache, **cache_options)
+bikeshare_data = CsvData(cache, args.csv_engine)
+with profiler.stage('load data'):
+    if args.workers and not args.chunksize:
+        all_city_data = bikeshare_data.get_data(workers=args.workers)
+    else:
+        # Cities loaded later on, e.g. by the --warm background thread, are
+        # timed as part of the query that is running at the time
+        profiler.instrument(bikeshare_data, ['_load_city', 'get_aggregates'])
+        all_city_data = bikeshare_data.get_loader(
+                warm=args.warm, chunksize=args.chunksize,
+                error_bound=args.approximate)
+bikeshare_stats = DataStats(all_city_data,
+        precompute=args.precompute or bool(args.batch or args.approximate),
+        cache_size=args.result_cache_size,
+        error_bound=args.approximate)
 validator = Validate()
 pprint = PrettyPrint()
+profiler.instrument(bikeshare_stats,
+                    ['filter_data', 'query', 'compare_cities',
+                     '_get_city_data', '_get_row_index', '_select_rows',
+                     'all_stats', 'top_stations', 'top_trips',
+                     *DataStats._stat_names])
+profiler.instrument(pprint,
+                    [name for name in dir(pprint) if name.startswith('show_')])
+profiler.end_query('startup')
 
 # Main loop
 city_names = bikeshare_data.get_city_names()
 
+# Batch mode: every query is answered from the per-city aggregates, so each
+# city's data is only scanned once
+if args.batch:
+    if args.batch == 'all':
+        queries = bike_funs.all_batch_queries(bikeshare_stats, city_names)
+    else:
+        try:
+            with open(args.batch) as query_file:
+                queries = bike_funs.read_batch_queries(validator, query_file,
+                                                       city_names)
+        except (OSError, ValueError) as err:
+            sys.exit(err)
+
+    out_file = open(args.output, 'w', newline='') if args.output \
+            else sys.stdout
+    profiler.start_query()
+    try:
+        with profiler.stage('write batch report'):
+            bike_funs.write_batch_report(bikeshare_stats, queries, out_file,
+                                         args.format)
+    except ValueError as err:
+        sys.exit(err)
+    profiler.end_query('batch report')
+    if args.output:
+        out_file.close()
+    sys.exit()
+
+# Server mode: the data stays loaded and each request is answered by one of a
+# pool of threads
+if args.serve:
+    server = QueryServer(bikeshare_stats, validator, city_names, args.host,
+                         args.serve, args.threads)
+    print("Serving bike share statistics on http://{}:{}/".format(
+            *server.address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    sys.exit()
+
 # Intro
 print("Hello. Let's explore some bike share data.")
 
@@ -27,11 +177,41 @@ while True:
     # Get filter options
     filter_options = bike_funs.get_filter_options(validator, city_names)
 
-    # Calculate stats
-    all_stats = bike_funs.calculate_stats(bikeshare_stats, filter_options)
+    # Calculate stats. Several cities are compared side by side, with the
+    # cities computed in parallel.
+    comparing = bike_funs.is_comparison(filter_options)
+    profiler.start_query()
+    try:
+        if comparing:
+            with profiler.stage('calculate comparison'):
+                comparison = bike_funs.calculate_comparison(bikeshare_stats,
+                                                            filter_options)
+        else:
+            with profiler.stage('calculate stats'):
+                all_stats = bike_funs.calculate_stats(bikeshare_stats,
+                                                      filter_options)
+    except ValueError as err:
+        # e.g. a date range when only aggregates were loaded
+        print("\n{}\n".format(err))
+        continue
 
     # Display stats
-    bike_funs.display_stats(pprint, filter_options, all_stats)
+    if comparing:
+        with profiler.stage('display comparison'):
+            bike_funs.display_comparison(pprint, filter_options, comparison)
+    else:
+        with profiler.stage('display stats'):
+            bike_funs.display_stats(pprint, filter_options, all_stats)
+
+    # Rank the most popular stations and trips of a single city
+    if args.top and not comparing:
+        with profiler.stage('calculate top'):
+            top_stations, top_trips = bike_funs.calculate_top(
+                    bikeshare_stats, filter_options, args.top)
+        with profiler.stage('display top'):
+            bike_funs.display_top(pprint, top_stations, top_trips)
+    profiler.end_query(', '.join(str(option) for option in filter_options
+                                 if option))
 
     # Ask the user if they would like to quit
     if validator.quit_program():
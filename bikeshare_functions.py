@@ -2,6 +2,9 @@
 #   bikeshare_functions.py - contains some functions for the main program.
 #
 
+import csv
+import json
+
 def get_filter_options(validator_obj, city_names):
     '''
     Use a Validate object to get all of the filter options.
@@ -9,34 +12,36 @@ def get_filter_options(validator_obj, city_names):
     filter_city = validator_obj.get_city_filter(city_names)
     filter_mode = validator_obj.get_filter_mode()
     filter_comp = validator_obj.get_filter_components()
+    hours = validator_obj.get_hour_range()
 
-    return [filter_city, filter_mode, filter_comp]
+    return [filter_city, filter_mode, filter_comp, hours]
 
 def calculate_stats(data_stats_obj, filter_options):
     '''
     Use a DataStats object to calculate all statistics
     '''
-    # Get filter options and filter data
-    filter_city, filter_mode, filter_comp = filter_options
-    data_stats_obj.filter_data(filter_city, filter_mode)
-
-    # Calculate stats
-    pop_start_time = data_stats_obj.popular_start_time(filter_comp)
-    popular_stations = data_stats_obj.popular_stations(filter_comp)
-    popular_trip = data_stats_obj.popular_trip(filter_comp)
-    trip_duration = data_stats_obj.trip_duration(filter_comp)
-    counts_user = data_stats_obj.counts_user(filter_comp)
-    counts_gender = data_stats_obj.counts_gender(filter_comp)
-    birth_years = data_stats_obj.birth_years(filter_comp)
-
-    # Compile all stats into a list
-    all_stats = [pop_start_time,
-                 popular_stations,
-                 popular_trip,
-                 trip_duration,
-                 counts_user,
-                 counts_gender,
-                 birth_years]
+    # Get filter options and plan the query
+    filter_city, filter_mode, filter_comp, hours = filter_options
+    query = data_stats_obj.query(filter_city, filter_mode, filter_comp, hours)
+
+    # Calculate stats in one pass
+    stats = data_stats_obj.all_stats(query)
+
+    return order_stats(stats)
+
+def order_stats(stats):
+    '''
+    Compile the statistics returned by DataStats.all_stats into a list, in the
+    order they are displayed.
+    '''
+    all_stats = [stats['popular_start_time'],
+                 stats['popular_stations'],
+                 stats['popular_trip'],
+                 stats['trip_duration'],
+                 stats['duration_distribution'],
+                 stats['counts_user'],
+                 stats['counts_gender'],
+                 stats['birth_years']]
 
     return all_stats
 
@@ -45,11 +50,12 @@ def display_stats(pprint_obj, filter_options, all_stats):
     Use a PrettyPrint object to display all calculated stats.
     '''
     # Get stats and filter options
-    p_start, p_stations, p_trip, trip_dur, counts_u, counts_g, birth = all_stats
-    filter_city, filter_mode, filter_comp = filter_options
+    (p_start, p_stations, p_trip, trip_dur, dur_dist, counts_u, counts_g,
+     birth) = all_stats
+    filter_city, filter_mode, filter_comp, hours = filter_options
 
     # Set filter options and print main header
-    pprint_obj.get_filter_options(filter_city, filter_mode, filter_comp)
+    pprint_obj.get_filter_options(filter_city, filter_mode, filter_comp, hours)
     pprint_obj.main_header()
 
     # Print all stats
@@ -57,6 +63,216 @@ def display_stats(pprint_obj, filter_options, all_stats):
     pprint_obj.show_stations_stats(p_stations)
     pprint_obj.show_trip_stats(p_trip)
     pprint_obj.show_trip_duration_stats(trip_dur)
+    pprint_obj.show_duration_distribution_stats(dur_dist)
     pprint_obj.show_user_count_stats(counts_u)
     pprint_obj.show_gender_count_stats(counts_g)
     pprint_obj.show_birth_year_stats(birth)
+
+def calculate_top(data_stats_obj, filter_options, k):
+    '''
+    Use a DataStats object to rank the k most popular stations and trips for
+    the filter options. Returns the top stations and the top trips.
+    '''
+    filter_city, filter_mode, filter_comp, hours = filter_options
+    query = data_stats_obj.query(filter_city, filter_mode, filter_comp, hours)
+
+    return (data_stats_obj.top_stations(query, k),
+            data_stats_obj.top_trips(query, k))
+
+def display_top(pprint_obj, top_stations, top_trips):
+    '''
+    Use a PrettyPrint object to display the ranked stations and trips.
+    '''
+    pprint_obj.show_top_stations(top_stations)
+    pprint_obj.show_top_trips(top_trips)
+
+def is_comparison(filter_options):
+    '''
+    Return True if the filter options name several cities to compare.
+    '''
+    return isinstance(filter_options[0], list)
+
+def calculate_comparison(data_stats_obj, filter_options):
+    '''
+    Use a DataStats object to calculate all statistics for each of the cities
+    in the filter options, in parallel. Returns a dictionary of the statistics
+    keyed by city name.
+    '''
+    filter_cities, filter_mode, filter_comp, hours = filter_options
+
+    return data_stats_obj.compare_cities(filter_cities, filter_mode,
+                                         filter_comp, hours)
+
+def display_comparison(pprint_obj, filter_options, comparison):
+    '''
+    Use a PrettyPrint object to display the statistics of several cities side
+    by side.
+    '''
+    filter_cities, filter_mode, filter_comp, hours = filter_options
+
+    pprint_obj.get_filter_options(', '.join(filter_cities), filter_mode,
+                                  filter_comp, hours)
+    pprint_obj.main_header()
+    pprint_obj.show_comparison(comparison)
+
+# Names of the statistics in the list returned by calculate_stats, used as
+# keys in batch reports
+stat_names = ['start_time',
+              'stations',
+              'trip',
+              'trip_duration',
+              'duration_distribution',
+              'user_types',
+              'genders',
+              'birth_years']
+
+def read_batch_queries(validator_obj, query_lines, city_names):
+    '''
+    Turn lines of the form "City[,Month[,Weekday]]" or
+    "City,First day[,Last day]", each optionally followed by an hour range
+    such as ",7-10", into filter options like the ones returned by
+    get_filter_options. Blank lines and lines starting with '#' are skipped.
+    '''
+    all_filter_options = []
+    for line_num, line in enumerate(query_lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields = [field.strip() for field in line.split(',')]
+        filter_city = validator_obj.match_city(fields[0], city_names)
+
+        hours = None
+        if len(fields) > 1:
+            hours = validator_obj.match_hour_range(fields[-1])
+            if hours:
+                fields = fields[:-1]
+
+        date_range = None
+        if len(fields) in [2, 3]:
+            date_range = validator_obj.match_date_range(' '.join(fields[1:]))
+        if filter_city and date_range:
+            all_filter_options.append([filter_city, 'r', date_range, hours])
+            continue
+
+        filter_comp = [validator_obj.match_month(fields[1])
+                       if len(fields) > 1 else None,
+                       validator_obj.match_day(fields[2])
+                       if len(fields) > 2 else None]
+
+        if (len(fields) > 3 or not filter_city or
+                None in filter_comp[:len(fields) - 1]):
+            raise ValueError("Invalid query on line {}: {}".format(line_num,
+                                                                   line))
+
+        if len(fields) == 1:
+            all_filter_options.append([filter_city, None, None, hours])
+        elif len(fields) == 2:
+            all_filter_options.append([filter_city, 'm', filter_comp[0],
+                                       hours])
+        else:
+            all_filter_options.append([filter_city, 'd', filter_comp, hours])
+
+    return all_filter_options
+
+def all_batch_queries(data_stats_obj, city_names):
+    '''
+    Return filter options for every city unfiltered, by each month, and by
+    each month and weekday. Only months and weekdays with trips are included.
+    '''
+    all_filter_options = []
+    for filter_city in city_names:
+        all_filter_options.append([filter_city, None, None, None])
+
+        trip_counts = data_stats_obj.trip_counts(filter_city)
+        for month, weekday_counts in trip_counts.iterrows():
+            if weekday_counts.sum() == 0:
+                continue
+            all_filter_options.append([filter_city, 'm', month, None])
+            for weekday, count in weekday_counts.items():
+                if count > 0:
+                    all_filter_options.append([filter_city, 'd',
+                                               [month, weekday], None])
+
+    return all_filter_options
+
+def _to_builtin(value):
+    '''
+    Convert numpy scalars in the statistics to plain Python values.
+    '''
+    return value.item() if hasattr(value, 'item') else value
+
+def to_json(value):
+    '''
+    Return a value holding statistics, e.g. a query record, as a JSON string.
+    '''
+    return json.dumps(value, default=_to_builtin)
+
+def query_fields(filter_options):
+    '''
+    Return a dictionary describing the filter options of a query: city, filter
+    mode, month, weekday, first and last day and hours.
+    '''
+    filter_city, filter_mode, filter_comp, hours = filter_options
+
+    month, weekday, first_day, last_day = None, None, None, None
+    if filter_mode == 'm':
+        month = filter_comp
+    elif filter_mode == 'd':
+        month, weekday = filter_comp
+    elif filter_mode == 'r':
+        first_day, last_day = filter_comp
+
+    return {'city': filter_city,
+            'filter_mode': filter_mode,
+            'month': month,
+            'weekday': weekday,
+            'first_day': first_day,
+            'last_day': last_day,
+            'hours': hours}
+
+def query_record(filter_options, all_stats):
+    '''
+    Return a dictionary with the filter options of a query and its statistics
+    keyed by stat_names, as written to JSON Lines batch reports.
+    '''
+    record = query_fields(filter_options)
+    record['stats'] = dict(zip(stat_names, all_stats))
+    return record
+
+def write_batch_report(data_stats_obj, all_filter_options, out_file,
+                       out_format='jsonl'):
+    '''
+    Calculate the statistics for every set of filter options and write them to
+    a file, either as JSON Lines with one query per line or as CSV with one
+    statistic value per row.
+    '''
+    if out_format == 'csv':
+        writer = csv.writer(out_file)
+        writer.writerow(['city', 'filter_mode', 'month', 'weekday',
+                         'first_day', 'last_day', 'hours', 'statistic',
+                         'field', 'value'])
+
+    for filter_options in all_filter_options:
+        all_stats = calculate_stats(data_stats_obj, filter_options)
+        record = query_record(filter_options, all_stats)
+
+        if out_format == 'csv':
+            query = [record[field] or '' for field in
+                     ['city', 'filter_mode', 'month', 'weekday', 'first_day',
+                      'last_day']]
+            query.append('{}-{}'.format(*record['hours'])
+                         if record['hours'] else '')
+            for stat_name, stats in zip(stat_names, all_stats):
+                for field, value in (stats or {}).items():
+                    # Trip durations are split into years, months, etc.
+                    if isinstance(value, dict):
+                        for part, part_value in value.items():
+                            writer.writerow(query + [stat_name,
+                                                     field + ' ' + part,
+                                                     _to_builtin(part_value)])
+                    else:
+                        writer.writerow(query + [stat_name, field,
+                                                 _to_builtin(value)])
+        else:
+            out_file.write(to_json(record) + '\n')
@@ -0,0 +1,184 @@
+#
+#   column_store.py - Contains the ColumnStore class that keeps the converted
+#   columns of each city as .npy files, and the CityColumns class that opens
+#   them as memory-mapped arrays.
+#
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from data_cache import DataCache
+
+
+class CityColumns:
+    '''
+    A read-only, dataframe-like view of a city's columns in a ColumnStore
+    entry. Each column is memory-mapped the first time it is used, so only the
+    columns a query touches are read from disk, and processes on the same host
+    share the pages through the page cache.
+    '''
+
+    def __init__(self, entry_dir, layout):
+        '''
+        Initialize CityColumns object with the entry directory and the column
+        layout written by ColumnStore.store. No column is opened yet.
+        '''
+        self._entry_dir = entry_dir
+        self._layout = layout
+        self._columns = {}
+
+    @property
+    def columns(self):
+        '''
+        Names of the columns, in the order of the converted dataframe.
+        '''
+        return [col for col, kind, extra in self._layout]
+
+    def __len__(self):
+        return len(self[self.columns[0]])
+
+    def _open_array(self, file_name):
+        '''
+        Helper method to memory-map one .npy file of the entry.
+        '''
+        return np.load(os.path.join(self._entry_dir, file_name),
+                       mmap_mode='r')
+
+    def __getitem__(self, col):
+        '''
+        Return a column as a series backed by the memory-mapped arrays.
+        '''
+        if col not in self._columns:
+            for name, kind, extra in self._layout:
+                if name == col:
+                    break
+            else:
+                raise KeyError(col)
+
+            file_name = col.replace(' ', '_')
+            if kind == 'category':
+                categories, ordered = extra
+                values = pd.Categorical.from_codes(
+                        self._open_array(file_name + '.npy'),
+                        dtype=pd.CategoricalDtype(categories, ordered))
+            elif kind == 'masked':
+                values = pd.arrays.IntegerArray(
+                        self._open_array(file_name + '.npy'),
+                        self._open_array(file_name + '-mask.npy'))
+            else:
+                values = self._open_array(file_name + '.npy')
+            self._columns[col] = pd.Series(values, name=col, copy=False)
+
+        return self._columns[col]
+
+    def to_dataframe(self):
+        '''
+        Return all columns as an in-memory dataframe.
+        '''
+        return pd.DataFrame({col: self[col].copy() for col in self.columns})
+
+
+class ColumnStore(DataCache):
+    '''
+    A DataCache that stores each converted column of a city as a raw .npy
+    file: category codes, durations, start times, hours, trip codes and birth
+    years. Loading an entry only reads its layout; the columns are
+    memory-mapped on first use, so startup time doesn't depend on the size of
+    the data.
+    '''
+
+    def __init__(self, cache_dir='.bikeshare_columns', rebuild=False):
+        '''
+        Initialize ColumnStore object with the directory holding the entries.
+
+        Parameters
+
+            cache_dir: Path of the store directory. Created on the first store.
+
+            rebuild: If True, ignore existing entries so that every city is
+                     converted from its csv file again and re-stored.
+        '''
+        super().__init__(cache_dir, rebuild)
+        self._file_ext = '.columns'
+
+    def _remove_stale(self, csv_file, keep_path, prefix=None):
+        '''
+        Helper method to delete old entry directories for a csv file.
+        '''
+        if prefix is None:
+            prefix = self._source_prefix(csv_file)
+        for f in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, f)
+            if f.startswith(prefix) and path != keep_path:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def load(self, csv_file):
+        '''
+        Return a CityColumns object for a csv file, or None if there is no
+        up-to-date entry for it.
+
+        Parameters
+
+            csv_file: Path of the csv file the columns were converted from,
+                      or list of the partition files whose merged columns the
+                      entry holds.
+        '''
+        if self._rebuild:
+            return None
+
+        entry_dir = self._cache_path(csv_file)
+        try:
+            with open(os.path.join(entry_dir, 'layout.json')) as f:
+                return CityColumns(entry_dir, json.load(f))
+        except (OSError, ValueError):
+            # Treat missing or unreadable entries as missing
+            return None
+
+    def store(self, csv_file, city_data):
+        '''
+        Write every column of a converted dataframe to its own .npy file and
+        remove any older entries for the same csv file.
+
+        Parameters
+
+            csv_file: Path of the csv file the dataframe was converted from,
+                      or list of partition files as for load.
+
+            city_data: Converted dataframe.
+        '''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        entry_dir = self._cache_path(csv_file)
+
+        # Write to a temporary directory first so readers never see a partial
+        # entry
+        tmp_dir = entry_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        layout = []
+        for col in city_data.columns:
+            series = city_data[col]
+            file_path = os.path.join(tmp_dir, col.replace(' ', '_'))
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                np.save(file_path + '.npy', series.cat.codes.to_numpy())
+                layout.append((col, 'category',
+                               (list(series.cat.categories),
+                                series.cat.ordered)))
+            elif pd.api.types.is_extension_array_dtype(series.dtype):
+                np.save(file_path + '.npy',
+                        series.to_numpy(series.dtype.numpy_dtype, na_value=0))
+                np.save(file_path + '-mask.npy', series.isna().to_numpy())
+                layout.append((col, 'masked', None))
+            else:
+                np.save(file_path + '.npy', series.to_numpy())
+                layout.append((col, 'array', None))
+
+        with open(os.path.join(tmp_dir, 'layout.json'), 'w') as f:
+            json.dump(layout, f)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        self._remove_stale(csv_file, entry_dir)
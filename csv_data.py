@@ -4,8 +4,119 @@
 #
 
 import os
+import csv
+import functools
+import threading
+import numpy as np
 import pandas as pd
 import calendar as cal
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from pandas.api.types import union_categoricals
+from aggregates import CityAggregates
+
+
+def _export_to_shared_memory(city_data):
+    '''
+    Copy every column of a converted dataframe into its own shared memory
+    block. Returns a list describing the columns: name, kind, categories for
+    categorical columns, and the block name, dtype and length of each array.
+    Nullable integer columns are stored as a values array and a mask array.
+    If a column can't be exported, the blocks already written are freed.
+    '''
+    blocks = []
+
+    def export_array(values):
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(values.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(values.shape, values.dtype, block.buf)[:] = values
+        return block.name, values.dtype.str, len(values)
+
+    columns = []
+    try:
+        for col in city_data.columns:
+            series = city_data[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                columns.append((col, 'category',
+                                (list(series.cat.categories),
+                                 series.cat.ordered),
+                                [export_array(series.cat.codes.to_numpy())]))
+            elif pd.api.types.is_extension_array_dtype(series.dtype):
+                values = series.to_numpy(series.dtype.numpy_dtype, na_value=0)
+                columns.append((col, 'masked', None,
+                                [export_array(values),
+                                 export_array(series.isna().to_numpy())]))
+            else:
+                columns.append((col, 'array', None,
+                                [export_array(series.to_numpy())]))
+    except BaseException:
+        # The parent process never learns about these blocks, e.g. when
+        # /dev/shm is full, so they have to be removed here
+        for block in blocks:
+            block.close()
+            block.unlink()
+        raise
+
+    # The parent process frees the blocks once it has copied the columns out,
+    # so this process' resource tracker must not remove them on exit
+    for block in blocks:
+        block.close()
+        resource_tracker.unregister(block._name, 'shared_memory')
+
+    return columns
+
+
+def _import_from_shared_memory(columns):
+    '''
+    Rebuild a dataframe from the columns described by
+    _export_to_shared_memory. Each array is copied out of its shared memory
+    block and the block is freed, even if rebuilding fails part way.
+    '''
+    arrays = {}
+    try:
+        for col, kind, extra, blocks in columns:
+            for block_name, dtype, length in blocks:
+                block = shared_memory.SharedMemory(name=block_name)
+                arrays[block_name] = np.ndarray(length, dtype,
+                                                block.buf).copy()
+                block.close()
+                block.unlink()
+    finally:
+        # Free the blocks that weren't reached because of an error
+        for col, kind, extra, blocks in columns:
+            for block_name, dtype, length in blocks:
+                if block_name not in arrays:
+                    try:
+                        block = shared_memory.SharedMemory(name=block_name)
+                        block.close()
+                        block.unlink()
+                    except FileNotFoundError:
+                        pass
+
+    city_data = {}
+    for col, kind, extra, blocks in columns:
+        values = [arrays[block_name] for block_name, _, _ in blocks]
+        if kind == 'category':
+            categories, ordered = extra
+            city_data[col] = pd.Categorical.from_codes(
+                    values[0], categories=categories, ordered=ordered)
+        elif kind == 'masked':
+            city_data[col] = pd.arrays.IntegerArray(values[0], values[1])
+        else:
+            city_data[col] = values[0]
+
+    return pd.DataFrame(city_data)
+
+
+def _load_city_into_shared_memory(csv_data, city):
+    '''
+    Load the data for a city in a worker process and hand it back to the
+    parent process through shared memory instead of pickling the dataframe.
+    '''
+    return _export_to_shared_memory(csv_data.get_data(city))
 
 
 class CsvData:
@@ -13,28 +124,65 @@ class CsvData:
     A class for obtaining and filtering raw data from csv files.
     '''
 
-    # A list of all month names with empty string at index 0
-    _month_names = cal.month_name[:7]
+    # Fixed category orders for the calendar columns. Month and weekday values
+    # are stored as codes into these, so each name is only kept once.
+    _month_type = pd.CategoricalDtype(cal.month_name[1:], ordered=True)
+    _weekday_type = pd.CategoricalDtype(list(cal.day_name), ordered=True)
 
-    def __init__(self):
+    # Columns used by the program and the dtypes they are parsed with. Any
+    # other column in a csv file, such as End Time or the unnamed index, is
+    # skipped while parsing. Gender and Birth Year are optional.
+    _schema = {'Start Time': 'object',
+               'Trip Duration': 'float64',
+               'Start Station': 'category',
+               'End Station': 'category',
+               'User Type': 'category',
+               'Gender': 'category',
+               'Birth Year': 'float64'}
+
+    def __init__(self, cache=None, engine='c'):
         '''
         Initialize CsvData object with dictionary of the names of the csv files
-        in the current directory. If there are none, initialize empty
-        dictionary.
+        in the current directory, keyed by city. If there are none, initialize
+        empty dictionary.
+
+        Parameters
+
+            cache: Optional DataCache object used to store converted dataframes
+                   between runs, and the aggregates of csv files read in
+                   chunks. If None, every city is converted from its csv
+                   file.
+
+            engine: Parser engine passed to pandas.read_csv, 'c' or 'pyarrow'.
+                    The pyarrow engine requires pyarrow to be installed.
         '''
         self._filenames = {}
+        self._cache = cache
+        self._aggregate_cache = cache.aggregate_cache() if cache else None
+        self._engine = engine
         self._csv_files_available = None
         self.get_filenames()
 
     def get_filenames(self):
         '''
         Check for csv files in current directory and add them to the _filename
-        list. If there are no csv files, set _csv_files_available to False.
+        dictionary. The data for a city may be split into several partition
+        files, e.g. chicago.csv, chicago-2017-07.csv and chicago-2017-08.csv;
+        they are listed in name order, so partitions named by date are read
+        oldest first. Call again to pick up newly arrived partitions. If there
+        are no csv files, set _csv_files_available to False.
         '''
+        self._filenames = {}
+        csv_files = []
         for f in os.listdir("."):
             if f.endswith(".csv"):
-                key = f[:-4].replace("_", " ").title()
-                self._filenames[key] = f
+                # A city's file without a partition name sorts first
+                name, _, part = f[:-4].partition("-")
+                csv_files.append((name, part, f))
+
+        for name, part, f in sorted(csv_files):
+            key = name.replace("_", " ").title()
+            self._filenames.setdefault(key, []).append(f)
 
         if len(self._filenames) == 0:
             self._csv_files_available = False
@@ -54,35 +202,241 @@ class CsvData:
         '''
         return list(self._filenames.keys())
 
-    def _convert_to_dataframe(self, csv_file):
+    def _read_options(self, f):
+        '''
+        Helper method to get the pandas.read_csv options for an open csv file.
+        The header line tells which optional columns the file has; the file is
+        rewound afterwards so the parser sees the whole file.
+        '''
+        header = next(csv.reader([f.readline().decode()]))
+        f.seek(0)
+
+        usecols = [col for col in header if col in self._schema]
+        dtypes = {col: self._schema[col] for col in usecols}
+        if self._engine == 'pyarrow':
+            # pyarrow parses the timestamps itself, and much faster than it
+            # hands back Python strings
+            dtypes['Start Time'] = 'timestamp[s][pyarrow]'
+
+        return {'usecols': usecols, 'dtype': dtypes, 'engine': self._engine}
+
+    def _parse_start_time(self, city_data):
+        '''
+        Helper method to convert the Start Time column to seconds since the
+        epoch, which fits in 32 bits.
+        '''
+        # Start times have the fixed layout %Y-%m-%d %H:%M:%S, which numpy
+        # parses straight to seconds without any format inference
+        start_time = city_data['Start Time'].to_numpy().astype('datetime64[s]')
+        city_data['Start Time'] = start_time.astype('int64').astype('uint32')
+        return city_data
+
+    def _read_csv(self, csv_file):
+        '''
+        Helper method to parse the columns in the schema from a csv file. The
+        file is only opened and parsed once.
+        '''
+        with open(csv_file, 'rb') as f:
+            city_data = pd.read_csv(f, **self._read_options(f))
+
+        return self._parse_start_time(city_data)
+
+    def _read_csv_chunks(self, csv_file, chunksize):
+        '''
+        Helper method to parse a csv file like _read_csv, but yield it in
+        dataframes of at most chunksize rows.
+        '''
+        with open(csv_file, 'rb') as f:
+            options = self._read_options(f)
+
+            # The pyarrow engine can't read in chunks
+            if options['engine'] == 'pyarrow':
+                options['engine'] = 'c'
+                options['dtype']['Start Time'] = self._schema['Start Time']
+
+            for chunk in pd.read_csv(f, chunksize=chunksize, **options):
+                yield self._parse_start_time(chunk)
+
+    def _convert_to_dataframe(self, csv_file, station_names=None):
+        '''
+        Convert the specified csv file into a dataframe. If a station
+        dictionary is given, it is extended with the new stations of the file.
+        '''
+        return self._add_columns(self._read_csv(csv_file), station_names)
+
+    def _sort_by_start_time(self, city_data):
+        '''
+        Helper method to put the trips in start time order, so that any date
+        range is one run of rows that can be found with a binary search.
+        '''
+        start_time = city_data['Start Time'].to_numpy()
+        if (start_time[1:] < start_time[:-1]).any():
+            order = np.argsort(start_time, kind='stable')
+            city_data = city_data.take(order).reset_index(drop=True)
+
+        return city_data
+
+    def _trip_codes(self, start_station, end_station):
+        '''
+        Helper method to pack each start/end station pair into one integer
+        trip code, which can be turned back into station names with the
+        station dictionary. Trips with a missing station get the code -1.
+        '''
+        num_stations = len(start_station.categories)
+        start_codes = np.asarray(start_station.codes, dtype='int32')
+        end_codes = np.asarray(end_station.codes, dtype='int32')
+        trip_codes = start_codes * num_stations + end_codes
+        trip_codes[(start_codes < 0) | (end_codes < 0)] = -1
+        return trip_codes
+
+    def _add_columns(self, city_data, station_names=None):
+        '''
+        Helper method to sort freshly parsed city data by start time, narrow
+        its dtypes and add the month, weekday, hour and trip columns.
+
+        Parameters
+
+            city_data: Parsed city data.
+
+            station_names: Optional station dictionary of data converted
+                           earlier, e.g. older partitions of the same city.
+                           New stations are added after its names, so codes
+                           into it stay valid.
+        '''
+        city_data = self._sort_by_start_time(city_data)
+
+        # Use one station dictionary for both the start and end stations
+        new_names = city_data['Start Station'].cat.categories.union(
+                city_data['End Station'].cat.categories)
+        if station_names is None:
+            station_names = new_names
+        else:
+            station_names = station_names.append(
+                    new_names.difference(station_names))
+        station_type = pd.CategoricalDtype(station_names)
+        for col in ['Start Station', 'End Station']:
+            city_data[col] = city_data[col].astype(station_type)
+
+        # Birth years fit in 16 bits; keep missing values as <NA>
+        if 'Birth Year' in city_data.columns:
+            city_data['Birth Year'] = city_data['Birth Year'].astype('Int16')
+
+        # Add additional columns for grouping by month, weekday, hour, and trip.
+        # Month and weekday numbers map directly onto the category codes.
+        start_time = city_data['Start Time'].to_numpy('int64')
+        start_month = start_time.astype('datetime64[s]').astype('datetime64[M]')
+        city_data['Month'] = pd.Categorical.from_codes(
+                (start_month.astype('int64') % 12).astype('int8'),
+                dtype=self._month_type)
+
+        # Day 0 of the epoch, 1970-01-01, was a Thursday (weekday 3)
+        start_day = start_time // 86400
+        city_data['Weekday'] = pd.Categorical.from_codes(
+                ((start_day + 3) % 7).astype('int8'),
+                dtype=self._weekday_type)
+        city_data['Hour'] = (start_time % 86400 // 3600).astype('int8')
+
+        city_data['Trip'] = self._trip_codes(city_data['Start Station'].array,
+                                             city_data['End Station'].array)
+        return city_data
+
+    def _load_partition(self, csv_file, station_names=None):
+        '''
+        Helper method to get the converted data for one csv file, using the
+        cache if there is one. A cached partition is only used if its station
+        dictionary extends the given one, i.e. if it was converted after the
+        same older partitions.
+        '''
+        if self._cache:
+            city_data = self._cache.load(csv_file)
+            if city_data is not None:
+                cached_names = city_data['Start Station'].cat.categories
+                if station_names is None or cached_names[
+                        :len(station_names)].equals(station_names):
+                    return city_data
+
+        city_data = self._convert_to_dataframe(csv_file, station_names)
+        if self._cache:
+            self._cache.store(csv_file, city_data)
+
+        return city_data
+
+    def _merge_partitions(self, partitions):
+        '''
+        Helper method to combine the converted partitions of a city into one
+        dataframe. The station dictionary of each partition extends the one
+        of the partition before it, so the station codes of every partition
+        are valid in the last dictionary and are concatenated as they are.
+        '''
+        station_type = partitions[-1]['Start Station'].dtype
+        columns = [col for col in partitions[0].columns
+                   if all(col in partition.columns for partition in partitions)]
+
+        city_data = {}
+        for col in columns:
+            if col in ['Start Station', 'End Station']:
+                codes = np.concatenate([partition[col].cat.codes.to_numpy()
+                                        for partition in partitions])
+                city_data[col] = pd.Categorical.from_codes(codes,
+                                                           dtype=station_type)
+            elif isinstance(partitions[0][col].dtype, pd.CategoricalDtype):
+                # e.g. a user type that only shows up in later partitions
+                city_data[col] = union_categoricals(
+                        [partition[col] for partition in partitions])
+            elif col == 'Trip':
+                # Trip codes of older partitions were packed with fewer
+                # stations
+                city_data[col] = self._trip_codes(city_data['Start Station'],
+                                                  city_data['End Station'])
+            else:
+                city_data[col] = pd.concat(
+                        [partition[col] for partition in partitions],
+                        ignore_index=True)
+
+        return self._sort_by_start_time(pd.DataFrame(city_data))
+
+    def _load_city(self, csv_files):
         '''
-        Convert the specified csv file into a dataframe.
+        Return the dataframe for the specified csv files of a city, using the
+        cache if there is one. The merged data of several partition files is
+        cached as one entry, so a later run loads it as it is. When a new
+        partition arrives, only that partition is converted, extending the
+        station dictionary of the partitions before it, and is merged with
+        the cached entry for the older ones.
         '''
-        # Get csv file headers and remove unnecessary columns
-        headers = []
-        for col in pd.read_csv(csv_file, nrows=1).columns:
-            if 'unnamed' not in col.lower() and col != 'End Time':
-                headers.append(col)
+        if len(csv_files) == 1:
+            return self._load_partition(csv_files[0])
+
+        if self._cache:
+            city_data = self._cache.load(csv_files)
+            if city_data is not None:
+                return city_data
 
-        # Get dataframe from csv using the headers we just extracted
-        city_data = pd.read_csv(csv_file,
-                                usecols=headers,
-                                parse_dates=['Start Time'],
-                                infer_datetime_format=True)
+        # Start from the merged entry for the most partitions already cached
+        merged_count = 1
+        if self._cache:
+            for count in range(len(csv_files) - 1, 1, -1):
+                city_data = self._cache.load(csv_files[:count])
+                if city_data is not None:
+                    merged_count = count
+                    break
+        if merged_count == 1:
+            city_data = self._load_partition(csv_files[0])
 
-        # Add additional columns for grouping by month, weekday, hour, and trip
-        city_data['Month'] = city_data['Start Time'].dt.month.apply(
-                lambda x: self._month_names[x])
-        city_data['Weekday'] = city_data['Start Time'].dt.weekday_name
-        city_data['Hour'] = city_data['Start Time'].dt.hour
-        city_data['Trip'] = city_data['Start Station'] + '_' + \
-                city_data['End Station']
+        partitions = [city_data]
+        station_names = city_data['Start Station'].cat.categories
+        for csv_file in csv_files[merged_count:]:
+            city_data = self._load_partition(csv_file, station_names)
+            station_names = city_data['Start Station'].cat.categories
+            partitions.append(city_data)
+
+        city_data = self._merge_partitions(partitions)
+        if self._cache:
+            self._cache.store(csv_files, city_data)
 
-        # Drop Start Time column before returning
-        city_data.drop('Start Time', axis=1, inplace=True)
         return city_data
 
-    def get_data(self, city=None):
+    def get_data(self, city=None, workers=None):
         '''
         Return dataframe containing data for a specified city. If no city is
         specified, return a dictionary containing dataframes with data for all
@@ -93,6 +447,9 @@ class CsvData:
             city: name of the city whose bikeshare data is to be displayed.
                   Three choices: "Chicago", "New York", and "Washington".
 
+            workers: If more than one, load the cities in this many worker
+                     processes at once. Only used when no city is specified.
+
         Returns
 
             city_data: Either a dataframe or a dictionary of dataframes each
@@ -101,10 +458,217 @@ class CsvData:
         # Might need to raise custom error if _filenames is empty
         # Or just have method return empty dict
         if city:
-            city_file = self._filenames[city]
-            return self._convert_to_dataframe(city_file)
+            city_files = self._filenames[city]
+            return self._load_city(city_files)
+        elif workers and workers > 1 and len(self._filenames) > 1:
+            return self._get_data_parallel(workers)
         else:
             all_city_data = {}
-            for city_name, city_file in self._filenames.items():
-                all_city_data[city_name] = self._convert_to_dataframe(city_file)
+            for city_name, city_files in self._filenames.items():
+                all_city_data[city_name] = self._load_city(city_files)
             return all_city_data
+
+    def _get_data_parallel(self, workers):
+        '''
+        Helper method to load every city in a pool of worker processes. The
+        converted columns come back through shared memory, which avoids
+        pickling whole dataframes and sending them through a pipe.
+        '''
+        # Shared memory blocks on Windows disappear as soon as the worker
+        # closes them, so dataframes are pickled there instead
+        use_shared_memory = os.name != 'nt'
+
+        all_city_data = {}
+        errors = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            load_city = _load_city_into_shared_memory if use_shared_memory \
+                    else CsvData.get_data
+            futures = {city: executor.submit(load_city, self, city)
+                       for city in self._filenames}
+
+            # Collect every city, even after a failure, so that no shared
+            # memory block is left behind
+            for city, future in futures.items():
+                try:
+                    city_data = future.result()
+                    if use_shared_memory:
+                        city_data = _import_from_shared_memory(city_data)
+                    all_city_data[city] = city_data
+                except Exception as err:
+                    errors.append(err)
+
+        if errors:
+            raise errors[0]
+        return all_city_data
+
+    def get_aggregates(self, city, chunksize=1000000, error_bound=None):
+        '''
+        Return a CityAggregates object for a city, built by reading its csv
+        files in chunks. Only one chunk is held in memory at a time. With a
+        cache, the aggregates of each partition file are cached on their own
+        and merged, so only new or changed partitions are read.
+
+        Parameters
+
+            city: Name of the city whose bikeshare data is to be aggregated.
+
+            chunksize: Number of csv rows read and converted at a time.
+
+            error_bound: If given, count stations and trips approximately with
+                         bounded memory; see CityAggregates.
+
+        Returns
+
+            aggregates: CityAggregates object with counts and totals for every
+                        month, weekday and hour.
+        '''
+        aggregates = None
+        for csv_file in self._filenames[city]:
+            partition = self._aggregate_partition(csv_file, chunksize,
+                                                  error_bound)
+            if aggregates is None:
+                aggregates = partition
+            else:
+                aggregates.merge(partition)
+        return aggregates
+
+    def _aggregate_partition(self, csv_file, chunksize, error_bound):
+        '''
+        Helper method to get the CityAggregates object for one csv file,
+        using the cache if there is one. Station and trip counts are keyed by
+        station name, so the aggregates of partitions converted with
+        different station dictionaries can be merged as they are.
+        '''
+        if self._aggregate_cache:
+            aggregates = self._aggregate_cache.load(csv_file, error_bound)
+            if aggregates is not None:
+                return aggregates
+
+        aggregates = CityAggregates(error_bound)
+        for chunk in self._read_csv_chunks(csv_file, chunksize):
+            aggregates.update(self._add_columns(chunk))
+        if self._aggregate_cache:
+            self._aggregate_cache.store(csv_file, aggregates)
+
+        return aggregates
+
+    def get_loader(self, warm=False, chunksize=None, error_bound=None):
+        '''
+        Return a LazyCityData object that converts the csv file for a city only
+        the first time that city is requested.
+
+        Parameters
+
+            warm: If True, convert the remaining cities in a background thread
+                  so that later requests for them don't have to wait.
+
+            chunksize: If given, read csv files in chunks of this many rows and
+                       keep only CityAggregates objects instead of dataframes.
+
+            error_bound: Error bound of approximate station and trip counts in
+                         the CityAggregates objects, or None to count them
+                         exactly. Only used with chunksize.
+
+        Returns
+
+            loader: LazyCityData object mapping city names to dataframes or
+                    CityAggregates objects.
+        '''
+        load_city = self.get_data
+        if chunksize:
+            load_city = functools.partial(self.get_aggregates,
+                                          chunksize=chunksize,
+                                          error_bound=error_bound)
+        return LazyCityData(self.get_city_names(), load_city, warm)
+
+
+class LazyCityData(Mapping):
+    '''
+    A read-only mapping of city names to dataframes that loads each city on
+    demand and keeps it around for later requests.
+    '''
+
+    def __init__(self, city_names, load_city, warm=False):
+        '''
+        Initialize LazyCityData object with the names of the available cities
+        and the function used to load a single city.
+
+        Parameters
+
+            city_names: List of city names.
+
+            load_city: Function that takes a city name and returns the data for
+                       that city, e.g. the get_data method of a CsvData object.
+
+            warm: If True, start loading all cities in a background thread.
+        '''
+        self._city_names = list(city_names)
+        self._load_city = load_city
+        self._city_data = {}
+        self._locks = {city: threading.Lock() for city in self._city_names}
+        self._warm_thread = None
+
+        if warm:
+            self.warm()
+
+    def __getitem__(self, city):
+        '''
+        Return the data for the given city, loading it first if necessary.
+        '''
+        if city not in self._locks:
+            raise KeyError(city)
+
+        # Only one thread converts a given city; the others wait for it
+        with self._locks[city]:
+            if city not in self._city_data:
+                self._city_data[city] = self._load_city(city)
+
+        return self._city_data[city]
+
+    def __iter__(self):
+        return iter(self._city_names)
+
+    def __len__(self):
+        return len(self._city_names)
+
+    def is_loaded(self, city):
+        '''
+        Return True if the data for the given city has already been loaded.
+        '''
+        return city in self._city_data
+
+    def reload(self, city):
+        '''
+        Forget the loaded data for the given city so that it is loaded again
+        the next time it is requested.
+        '''
+        with self._locks[city]:
+            self._city_data.pop(city, None)
+
+    def _warm_cities(self, city_names):
+        '''
+        Helper method to load the given cities one after another. Errors are
+        ignored here so that they surface when the city is actually requested.
+        '''
+        for city in city_names:
+            try:
+                self[city]
+            except Exception:
+                pass
+
+    def warm(self, city_names=None):
+        '''
+        Load the given cities, or all cities if none are given, in a background
+        thread.
+
+        Parameters
+
+            city_names: List of city names to load. Defaults to all cities.
+        '''
+        if city_names is None:
+            city_names = self._city_names
+
+        self._warm_thread = threading.Thread(target=self._warm_cities,
+                                             args=(list(city_names),),
+                                             daemon=True)
+        self._warm_thread.start()
@@ -0,0 +1,243 @@
+#
+#   data_cache.py - Contains the DataCache class that keeps converted city
+#   dataframes on disk so later runs don't have to parse the csv files again,
+#   and the AggregateCache class that does the same for aggregated counts.
+#
+
+import os
+import pickle
+import hashlib
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class DataCache:
+    '''
+    A class for storing and retrieving converted dataframes in a binary cache
+    directory. Feather files are used when pyarrow is installed, pickle files
+    otherwise.
+    '''
+
+    # Bump this whenever the layout of the converted dataframes changes so that
+    # old cache entries are rebuilt.
+    _cache_version = 6
+
+    def __init__(self, cache_dir='.bikeshare_cache', rebuild=False):
+        '''
+        Initialize DataCache object with the directory holding the cache
+        entries.
+
+        Parameters
+
+            cache_dir: Path of the cache directory. Created on the first store.
+
+            rebuild: If True, ignore existing entries so that every city is
+                     converted from its csv file again and re-cached.
+        '''
+        self._cache_dir = cache_dir
+        self._rebuild = rebuild
+        self._file_ext = '.feather' if pyarrow else '.pkl'
+
+    def _source_prefix(self, csv_file):
+        '''
+        Helper method to get the part of the cache file name that identifies
+        the csv file. Entries holding the merged data of several partition
+        files are named after the first file with '+merged' added, so they
+        don't share the prefix of that file's own entry.
+        '''
+        csv_files = [csv_file] if isinstance(csv_file, str) else csv_file
+        csv_path = os.path.abspath(csv_files[0])
+        path_hash = hashlib.sha1(csv_path.encode()).hexdigest()[:12]
+        name = os.path.basename(csv_files[0])[:-4]
+        if len(csv_files) > 1:
+            name += '+merged'
+        return '{}-{}-'.format(name, path_hash)
+
+    def _cache_path(self, csv_file, prefix=None):
+        '''
+        Helper method to get the cache file path for a csv file, or for a list
+        of partition files. The name depends on the path, size and
+        modification time of every csv file so a changed csv file never
+        matches an old entry. The name starts with the given prefix, or with
+        the source prefix of the csv file if none is given.
+        '''
+        csv_files = [csv_file] if isinstance(csv_file, str) else csv_file
+        key_parts = []
+        for f in csv_files:
+            stat = os.stat(f)
+            key_part = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+            if len(csv_files) > 1:
+                key_part = os.path.basename(f) + ':' + key_part
+            key_parts.append(key_part)
+        key = '{}:{}'.format(':'.join(key_parts), self._cache_version)
+        key_hash = hashlib.sha1(key.encode()).hexdigest()[:12]
+        if prefix is None:
+            prefix = self._source_prefix(csv_file)
+        file_name = prefix + key_hash + self._file_ext
+        return os.path.join(self._cache_dir, file_name)
+
+    def _remove_stale(self, csv_file, keep_path, prefix=None):
+        '''
+        Helper method to delete old cache entries for a csv file, i.e. those
+        whose names start with the same prefix as the kept entry.
+        '''
+        if prefix is None:
+            prefix = self._source_prefix(csv_file)
+        for f in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, f)
+            if f.startswith(prefix) and path != keep_path:
+                os.remove(path)
+
+    def load(self, csv_file):
+        '''
+        Return the cached dataframe for a csv file, or None if there is no
+        up-to-date entry for it.
+
+        Parameters
+
+            csv_file: Path of the csv file the dataframe was converted from,
+                      or list of the partition files whose merged data the
+                      entry holds.
+        '''
+        if self._rebuild:
+            return None
+
+        cache_path = self._cache_path(csv_file)
+        if not os.path.exists(cache_path):
+            return None
+
+        try:
+            if self._file_ext == '.feather':
+                return pd.read_feather(cache_path)
+            return pd.read_pickle(cache_path)
+        except Exception:
+            # Treat unreadable entries as missing; they get overwritten
+            return None
+
+    def store(self, csv_file, city_data):
+        '''
+        Write the converted dataframe for a csv file to the cache and remove
+        any older entries for the same file.
+
+        Parameters
+
+            csv_file: Path of the csv file the dataframe was converted from,
+                      or list of partition files as for load.
+
+            city_data: Converted dataframe.
+        '''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        cache_path = self._cache_path(csv_file)
+
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = cache_path + '.tmp'
+        if self._file_ext == '.feather':
+            city_data.reset_index(drop=True).to_feather(tmp_path)
+        else:
+            city_data.to_pickle(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+        self._remove_stale(csv_file, cache_path)
+
+    def aggregate_cache(self):
+        '''
+        Return an AggregateCache kept in the aggregates subdirectory of this
+        cache.
+        '''
+        return AggregateCache(os.path.join(self._cache_dir, 'aggregates'),
+                              self._rebuild)
+
+
+class AggregateCache(DataCache):
+    '''
+    A DataCache for the CityAggregates objects built from csv files that are
+    read in chunks. Each csv file has its own entry, so when a city's data is
+    split into partition files, only new or changed partitions are read and
+    the others are merged from their entries. Exact and approximate
+    aggregates of a file are kept in separate entries. Entries are pickle
+    files.
+    '''
+
+    # Bump this whenever the layout of CityAggregates changes
+    _cache_version = 1
+
+    def __init__(self, cache_dir='.bikeshare_cache/aggregates', rebuild=False):
+        '''
+        Initialize AggregateCache object with the directory holding the cache
+        entries.
+
+        Parameters
+
+            cache_dir: Path of the cache directory. Created on the first store.
+
+            rebuild: If True, ignore existing entries so that every csv file
+                     is aggregated again and re-cached.
+        '''
+        super().__init__(cache_dir, rebuild)
+        self._file_ext = '.pkl'
+
+    def _bound_prefix(self, csv_file, error_bound):
+        '''
+        Helper method to get the start of the entry names for a csv file
+        aggregated with an error bound, so that exact and approximate entries
+        of the same file don't replace each other.
+        '''
+        if error_bound is None:
+            counts = 'exact'
+        else:
+            counts = 'approx{!r}'.format(error_bound)
+        return '{}{}-'.format(self._source_prefix(csv_file), counts)
+
+    def load(self, csv_file, error_bound=None):
+        '''
+        Return the cached CityAggregates object for a csv file, or None if
+        there is no up-to-date entry for it built with the same error bound.
+
+        Parameters
+
+            csv_file: Path of the csv file that was aggregated.
+
+            error_bound: Error bound of approximate station and trip counts,
+                         or None for exact counts; see CityAggregates.
+        '''
+        if self._rebuild:
+            return None
+
+        try:
+            prefix = self._bound_prefix(csv_file, error_bound)
+            with open(self._cache_path(csv_file, prefix), 'rb') as f:
+                aggregates = pickle.load(f)
+        except Exception:
+            # Treat missing or unreadable entries as missing
+            return None
+
+        if aggregates.error_bound != error_bound:
+            return None
+        return aggregates
+
+    def store(self, csv_file, aggregates):
+        '''
+        Write the CityAggregates object for a csv file to the cache and remove
+        any older entries for the same file.
+
+        Parameters
+
+            csv_file: Path of the csv file that was aggregated.
+
+            aggregates: CityAggregates object built from the whole file.
+        '''
+        os.makedirs(self._cache_dir, exist_ok=True)
+        prefix = self._bound_prefix(csv_file, aggregates.error_bound)
+        cache_path = self._cache_path(csv_file, prefix)
+
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(aggregates, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+        self._remove_stale(csv_file, cache_path, prefix)
@@ -1,54 +1,636 @@
 #
 #   data_stats.py - Contains the DataStats class that handles the computation of
-#   certain statistics on the data from the project csv files.
+#   certain statistics on the data from the project csv files, and the
+#   QueryPlan class describing one query.
 #
 
+import copy
+import functools
+import threading
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from aggregates import CityAggregates
+
+
+def cache_result(stat_method):
+    '''
+    Decorator for DataStats statistic methods that keeps their results in the
+    object's result cache, keyed by city, filter mode, filter components,
+    hour range and statistic, including any arguments after the query. The
+    query may be a QueryPlan or, for the filter set by filter_data, the
+    filter components; either way the statistic method is passed a QueryPlan.
+    '''
+    @functools.wraps(stat_method)
+    def cached_stat_method(self, query=None, *args, **kwargs):
+        query = self._get_query(query)
+        stat_name = stat_method.__name__
+        if args or kwargs:
+            stat_name = (stat_name, *args, *sorted(kwargs.items()))
+        return self._get_cached(stat_name, query,
+                                lambda: stat_method(self, query, *args,
+                                                    **kwargs))
+
+    return cached_stat_method
+
+
+class QueryPlan:
+    '''
+    An immutable description of one query: the city, filter mode, filter
+    components and hour range, together with the city's data and the rows
+    the filter selects. A QueryPlan is made by DataStats.query and passed to
+    the statistic methods in place of the filter components.
+
+    The city data is shared with every other query and only ever read, so
+    any number of queries can be answered at once from different threads
+    without copying data or taking locks. Columns of the selected rows are
+    taken the first time a statistic asks for them and kept for the other
+    statistics of the same query.
+    '''
+    __slots__ = ['_key', '_city_data', '_rows', '_data_version', '_columns']
+
+    def __init__(self, city_name, city_data, filter_mode=None, filter_by=None,
+                 hours=None, rows=None, data_version=0):
+        '''
+        Initialize QueryPlan object. Use DataStats.query rather than calling
+        this directly.
+
+        Parameters
+
+            city_name: Name of the city.
+
+            city_data: The city's dataframe, or its CityAggregates or
+                       CityColumns object.
+
+            filter_mode: 'm', 'd', 'r' or None, as for DataStats.filter_data.
+
+            filter_by: Filter components for the filter mode.
+
+            hours: Hour range as a tuple of the first and stop hour, or None.
+
+            rows: Row numbers, or a slice of rows, selected by the filter, or
+                  None if every row is selected or the city data is
+                  aggregated.
+
+            data_version: Version of the city's data the query was made
+                          from, counting the times the city was reloaded; see
+                          DataStats.reload_city.
+        '''
+        if isinstance(filter_by, list):
+            filter_by = tuple(filter_by)
+        self._key = (city_name, filter_mode, filter_by,
+                     tuple(hours) if hours else None)
+        self._city_data = city_data
+        self._rows = rows
+        self._data_version = data_version
+        self._columns = {}
+
+    def __repr__(self):
+        return 'QueryPlan({!r}, {!r}, {!r}, hours={!r})'.format(*self._key)
+
+    @property
+    def key(self):
+        '''
+        Tuple of the city name, filter mode, filter components and hour range.
+        '''
+        return self._key
+
+    @property
+    def city_name(self):
+        '''
+        Name of the city.
+        '''
+        return self._key[0]
+
+    @property
+    def filter_mode(self):
+        '''
+        Filter mode: 'm', 'd', 'r' or None.
+        '''
+        return self._key[1]
+
+    @property
+    def filter_by(self):
+        '''
+        Filter components, with lists turned into tuples.
+        '''
+        return self._key[2]
+
+    @property
+    def hours(self):
+        '''
+        Hour range as a tuple of the first and stop hour, or None.
+        '''
+        return self._key[3]
+
+    @property
+    def city_data(self):
+        '''
+        The data of the city as it was when the query was made.
+        '''
+        return self._city_data
+
+    @property
+    def data_version(self):
+        '''
+        Version of the city's data the query was made from.
+        '''
+        return self._data_version
+
+    def column(self, col):
+        '''
+        Return the values of a column in the rows selected by the query. A
+        date range is one run of rows, so its columns are views. Two threads
+        asking for the same new column at once both take it, which is
+        harmless.
+        '''
+        if self._rows is None:
+            return self._city_data[col]
+
+        values = self._columns.get(col)
+        if values is None:
+            if isinstance(self._rows, slice):
+                values = self._city_data[col].iloc[self._rows]
+            else:
+                values = self._city_data[col].take(self._rows)
+            self._columns[col] = values
+
+        return values
+
+
+class _FilterState(threading.local):
+    '''
+    The filter set by filter_data and the last query made for it. Every
+    thread has its own, so that queries for different cities can run at the
+    same time.
+    '''
+    city = None
+    mode = None
+    hours = None
+    query = None
 
 
 class DataStats:
     '''
     A class for computing basic descriptive statistics on bikeshare data.
+    Statistics are asked for with a QueryPlan from the query method, or for
+    the filter set by filter_data in the calling thread.
     '''
 
-    def __init__(self, all_city_data):
+    # Statistic methods computed together by all_stats
+    _stat_names = ['popular_start_time', 'trip_duration',
+                   'duration_distribution', 'popular_stations',
+                   'popular_trip', 'counts_gender', 'counts_user',
+                   'birth_years']
+
+    # Trip duration percentiles reported by duration_distribution
+    _percentiles = [50, 90, 99]
+    _percentile_labels = ['Median', '90th Percentile', '99th Percentile']
+
+    # Bins of the trip duration histogram: the upper bound in seconds of
+    # every bin but the last, which has none
+    _histogram_edges = [300, 600, 900, 1200, 1800, 3600, 7200, 86400]
+    _histogram_labels = ['Under 5 min', '5-10 min', '10-15 min', '15-20 min',
+                         '20-30 min', '30-60 min', '1-2 h', '2-24 h',
+                         '1 d and over']
+
+    def __init__(self, all_city_data, precompute=False, cache_size=128,
+                 error_bound=None):
         '''
         Initialize DataStats object with data for all cities. This data is
-        passed to the object as a dictionary of dataframes. Also initialize the
-        city name, filter mode and filter criteria.
+        passed to the object as a dictionary of dataframes or as a
+        LazyCityData object that loads each city the first time it is used.
+        CityAggregates objects, or the memory-mapped CityColumns objects of a
+        ColumnStore, may be used in place of dataframes. Also initialize the
+        result cache and the per-thread filter set by filter_data.
 
         Parameters
 
             all_city_data: Dictionary containing all dataframes of all bikeshare
                            csv files. Should be generated using the get_data
-                           method of a CsvData object.
+                           or get_loader method of a CsvData object.
+
+            precompute: If True, build a CityAggregates object for each city
+                        the first time the city is used and answer every query
+                        from it instead of scanning the dataframe.
+
+            cache_size: Maximum number of statistic results to keep. The least
+                        recently used result is dropped first. 0 turns off the
+                        result cache.
+
+            error_bound: If given, precomputed aggregates count stations and
+                         trips approximately with bounded memory; see
+                         CityAggregates.
         '''
         self._all_city_data = all_city_data
-        self._filtered_data = None
-        self._data_is_filtered = False
-        self._city_name = None
-        self._filter_mode = None
+        self._precompute = precompute
+        self._error_bound = error_bound
+        self._city_aggregates = {}
+        self._result_cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._row_index = {}
+        self._data_versions = {}
+        self._lock = threading.Lock()
+        # Held while a city's aggregates or row index are built; created on
+        # first use, since cities can be added to all_city_data later
+        self._city_locks = {}
+        self._locks_lock = threading.Lock()
+        self._filter = _FilterState()
+
+    def _get_city_data(self, city_name, needs_trips=False):
+        '''
+        Helper method to get the data for a city. If aggregates are being
+        precomputed, this is the city's CityAggregates object, unless the
+        query needs the trips themselves, as date range and hour range
+        filters do.
+        '''
+        city_data = self._all_city_data[city_name]
+        if needs_trips:
+            if isinstance(city_data, CityAggregates):
+                raise ValueError("Date range and hour range filters need the "
+                                 "trip data, which isn't kept when only "
+                                 "aggregates are loaded")
+        elif self._precompute and not isinstance(city_data, CityAggregates):
+            # Aggregates are kept with the data they were built from, so that
+            # aggregates of data replaced by a reload are never used
+            aggregated = self._city_aggregates.get(city_name)
+            if aggregated is None or aggregated[0] is not city_data:
+                # Only one thread aggregates a given city; the others wait for
+                # it instead of repeating the pass over its trips
+                with self._city_lock(city_name):
+                    aggregated = self._city_aggregates.get(city_name)
+                    if aggregated is None or aggregated[0] is not city_data:
+                        aggregated = (city_data, CityAggregates.from_dataframe(
+                                city_data, self._error_bound))
+                        self._city_aggregates[city_name] = aggregated
+            city_data = aggregated[1]
+
+        return city_data
+
+    def _city_lock(self, city_name):
+        '''
+        Helper method to get the lock held while a city's aggregates or row
+        index are built.
+        '''
+        with self._locks_lock:
+            return self._city_locks.setdefault(city_name, threading.Lock())
 
-    def _check_columns_exist(self, cols):
+    def _get_query(self, query):
+        '''
+        Helper method to get the QueryPlan a statistic method was called
+        with. Filter components are combined with the filter set by
+        filter_data in this thread; the QueryPlan made for them is kept, so
+        that the statistics of one filter share the selected rows.
+        '''
+        if isinstance(query, QueryPlan):
+            return query
+
+        current = self._filter
+        plan = current.query
+        filter_by = tuple(query) if isinstance(query, list) else query
+        if (plan is None or
+                plan.data_version != self._data_versions.get(current.city, 0) or
+                plan.key != (current.city, current.mode, filter_by,
+                             current.hours)):
+            plan = self.query(current.city, current.mode, filter_by,
+                              current.hours)
+            current.query = plan
+
+        return plan
+
+    def _get_cached(self, stat_name, query, calculate):
+        '''
+        Helper method to look up a statistic for a query in the result cache,
+        calculating and storing it on a miss. Copies are handed out so that
+        callers can't change the cached result.
+        '''
+        if not self._cache_size:
+            return calculate()
+
+        # The data version keeps results of queries made before the city was
+        # reloaded apart from those made after it
+        key = query.key + (query.data_version, stat_name)
+
+        # The lock only guards the cache itself and is released while a
+        # result is calculated, so queries for other cities aren't held up
+        with self._lock:
+            is_cached = key in self._result_cache
+            if is_cached:
+                self._cache_hits += 1
+                self._result_cache.move_to_end(key)
+                result = self._result_cache[key]
+            else:
+                self._cache_misses += 1
+
+        if not is_cached:
+            result = calculate()
+            with self._lock:
+                self._result_cache[key] = result
+                if len(self._result_cache) > self._cache_size:
+                    self._result_cache.popitem(last=False)
+
+        return copy.deepcopy(result)
+
+    def _check_columns_exist(self, query, cols):
         '''
         Helper method to check if the given columns exist.
         '''
         for col in cols:
-            if col not in self._all_city_data[self._city_name].columns:
+            if col not in query.city_data.columns:
                 return False
 
         return True
 
-    def _get_filtered_pop(self, col, filter_by):
+    def _get_row_index(self, city_name, city):
+        '''
+        Helper method to get the row index of a city: the row numbers ordered
+        by month, weekday and hour, and the offset in that order at which each
+        month/weekday/hour cell starts. Built the first time the city is
+        filtered, and rebuilt if the city's data has been reloaded since.
+        '''
+        indexed = self._row_index.get(city_name)
+        if indexed is None or indexed[0] is not city:
+            # Only one thread indexes a given city; the others wait for it
+            with self._city_lock(city_name):
+                indexed = self._row_index.get(city_name)
+                if indexed is None or indexed[0] is not city:
+                    indexed = (city, self._build_row_index(city))
+                    self._row_index[city_name] = indexed
+
+        return indexed[1]
+
+    def _build_row_index(self, city):
+        '''
+        Helper method to sort the row numbers of a city's data by month,
+        weekday and hour cell, and find the offset of every cell.
+        '''
+        num_weekdays = len(city['Weekday'].cat.categories)
+        cells = ((city['Month'].cat.codes.to_numpy('int64') * num_weekdays +
+                  city['Weekday'].cat.codes.to_numpy('int64')) * 24 +
+                 city['Hour'].to_numpy('int64'))
+
+        num_cells = len(city['Month'].cat.categories) * num_weekdays * 24
+        offsets = np.zeros(num_cells + 1, dtype='int64')
+        offsets[1:] = np.cumsum(np.bincount(cells, minlength=num_cells))
+        order = np.argsort(cells, kind='stable').astype('int32')
+        return order, offsets
+
+    def _get_hour_runs(self, hours):
+        '''
+        Helper method to get an hour range as runs of hours, first hour and
+        stop hour (exclusive). A range that wraps around midnight is two runs.
+        '''
+        start, stop = hours
+        if start < stop:
+            return [(start, stop)]
+        return [(start, 24), (0, stop)]
+
+    def _get_cell_runs(self, query):
+        '''
+        Helper method to get the month/weekday/hour cells selected by a query
+        as runs of cells, first cell and stop cell (exclusive). Cells are
+        ordered by month, then weekday, then hour, so a month or a month and
+        weekday is one run of cells. An hour range adds one run per month and
+        weekday.
+        '''
+        city = query.city_data
+        months = city['Month'].cat.categories
+        cells_per_month = len(city['Weekday'].cat.categories) * 24
+
+        if query.filter_mode == 'm':
+            month = months.get_loc(query.filter_by)
+            start = month * cells_per_month
+            stop = start + cells_per_month
+        elif query.filter_mode == 'd':
+            f1, f2 = query.filter_by
+            month = months.get_loc(f1)
+            weekday = city['Weekday'].cat.categories.get_loc(f2)
+            start = month * cells_per_month + weekday * 24
+            stop = start + 24
+        else:
+            start, stop = 0, len(months) * cells_per_month
+
+        if not query.hours:
+            return [(start, stop)]
+
+        return [(day_start + first_hour, day_start + stop_hour)
+                for day_start in range(start, stop, 24)
+                for first_hour, stop_hour in self._get_hour_runs(query.hours)]
+
+    def _get_filtered_rows(self, query):
+        '''
+        Helper method to get the row numbers of a city that match a query,
+        i.e. the union of one or more runs of the row index.
+        '''
+        order, offsets = self._get_row_index(query.city_name, query.city_data)
+        runs = [order[offsets[start]:offsets[stop]]
+                for start, stop in self._get_cell_runs(query)]
+
+        return runs[0] if len(runs) == 1 else np.concatenate(runs)
+
+    def _get_date_range(self, query):
+        '''
+        Helper method to get the first and last (exclusive) row of a city that
+        started within the date range of a query. Trips are sorted by start
+        time, so both are found with a binary search.
+        '''
+        first_day, last_day = query.filter_by
+        start = pd.Timestamp(first_day).normalize()
+        stop = pd.Timestamp(last_day).normalize() + pd.Timedelta(days=1)
+
+        start_time = query.city_data['Start Time']
+        return np.searchsorted(start_time.to_numpy(),
+                               [start.timestamp(), stop.timestamp()])
+
+    def _get_hour_rows(self, query, rows):
+        '''
+        Helper method to get the row numbers within a run of rows, such as a
+        date range, whose start hour is in the hour range of a query.
+        '''
+        hours = query.city_data['Hour'].iloc[rows].to_numpy()
+        in_range = np.zeros(len(hours), dtype=bool)
+        for first_hour, stop_hour in self._get_hour_runs(query.hours):
+            in_range |= (hours >= first_hour) & (hours < stop_hour)
+
+        return rows.start + np.flatnonzero(in_range)
+
+    def _select_rows(self, query):
+        '''
+        Helper method to find the rows of a city that match a query: a slice
+        for a date range, row numbers for any other filter, or None if the
+        query isn't filtered or is answered from aggregates. Only the row
+        numbers are found here; the columns are taken by QueryPlan.column.
+        '''
+        if (isinstance(query.city_data, CityAggregates) or
+                not (query.filter_mode or query.hours)):
+            return None
+
+        if query.filter_mode == 'r':
+            rows = slice(*self._get_date_range(query))
+            if query.hours:
+                rows = self._get_hour_rows(query, rows)
+            return rows
+
+        return self._get_filtered_rows(query)
+
+    def _cell_counts(self, col, query):
+        '''
+        Helper method to count the trips in each month, weekday or hour for
+        a query. The counts come straight from the offsets of the row index,
+        so no rows are scanned.
+        '''
+        city = query.city_data
+        months = city['Month'].cat.categories
+        weekdays = city['Weekday'].cat.categories
+        _, offsets = self._get_row_index(query.city_name, city)
+
+        cube = np.zeros(len(offsets) - 1, dtype='int64')
+        for start, stop in self._get_cell_runs(query):
+            cube[start:stop] = np.diff(offsets[start:stop + 1])
+        cube = cube.reshape(len(months), len(weekdays), 24)
+
+        if col == 'Month':
+            return pd.Series(cube.sum(axis=(1, 2)), index=months)
+        elif col == 'Weekday':
+            return pd.Series(cube.sum(axis=(0, 2)), index=weekdays)
+        return pd.Series(cube.sum(axis=(0, 1)), index=range(24))
+
+    def _column_counts(self, values):
+        '''
+        Helper method to count the values of a categorical or integer column
+        with a single bincount over its integer codes. Missing values, and
+        negative integers such as the -1 of a trip with a missing station, are
+        skipped. Values that don't occur may be included with a count of 0.
+        '''
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy('int64')
+            counts = np.bincount(codes[codes >= 0],
+                                 minlength=len(values.cat.categories))
+            return pd.Series(counts, index=values.cat.categories)
+
+        values = values.dropna().to_numpy('int64')
+        values = values[values >= 0]
+        if not len(values):
+            return pd.Series([], dtype='int64')
+
+        lowest = values.min()
+        counts = np.bincount(values - lowest)
+        return pd.Series(counts, index=np.arange(lowest, lowest + len(counts)))
+
+    def _value_counts(self, col, query):
+        '''
+        Helper method to retrieve the value counts of a column for a query.
+        Trips are counted by start and end station.
+        '''
+        city = query.city_data
+        if isinstance(city, CityAggregates):
+            return city.value_counts(col, query.filter_mode, query.filter_by)
+
+        if col in ['Month', 'Weekday', 'Hour'] and query.filter_mode != 'r':
+            return self._cell_counts(col, query)
+
+        counts = self._column_counts(query.column(col))
+
+        if col == 'Trip':
+            counts = self._decode_trips(query, counts[counts > 0])
+
+        return counts
+
+    def _decode_trips(self, query, counts):
+        '''
+        Helper method to replace the trip codes in the index of trip counts by
+        start and end station names. Trip codes pack the start and end station
+        codes.
+        '''
+        station_names = query.city_data['Start Station'].cat.categories
+        start_codes, end_codes = np.divmod(counts.index.to_numpy('int64'),
+                                           len(station_names))
+        counts.index = pd.MultiIndex.from_arrays(
+                [station_names[start_codes], station_names[end_codes]])
+        return counts
+
+    def _top_k(self, counts, k):
+        '''
+        Helper method to get the k largest counts, largest first, without
+        sorting all of them. Ties are broken by the order of the index, as
+        with idxmax. Counts of 0 are left out.
+        '''
+        values = counts.to_numpy()
+        if k < len(values):
+            # Partial selection finds the k-th largest count; every count at
+            # least that large is a candidate, so ties at the cut-off are
+            # still resolved by position
+            kth_largest = values[np.argpartition(-values, k - 1)[k - 1]]
+            rows = np.flatnonzero(values >= kth_largest)
+        else:
+            rows = np.arange(len(values))
+
+        rows = rows[np.lexsort((rows, -values[rows]))][:k]
+        top = counts.iloc[rows]
+        return top[top > 0]
+
+    def _top_counts(self, col, query, k):
+        '''
+        Helper method to retrieve the k most common values of a column for a
+        query. Only the selected trip codes are turned into station names.
+        '''
+        if col == 'Trip' and not isinstance(query.city_data, CityAggregates):
+            counts = self._column_counts(query.column(col))
+            return self._decode_trips(query, self._top_k(counts, k))
+
+        return self._top_k(self._value_counts(col, query), k)
+
+    def _get_pop(self, col, query):
+        '''
+        Helper method to retrieve most popular value for a query, or None if
+        there are no trips.
+        '''
+        top = self._top_counts(col, query, 1)
+        return top.index[0] if len(top) else None
+
+    def _duration_totals(self, query):
         '''
-        Helper method to retrieve most popular value from filtered data.
+        Helper method to retrieve the total and mean trip duration in seconds
+        for a query.
         '''
-        counts = self._filtered_data[col].value_counts()
-        if self._filter_mode == 'm':
-            return counts.loc[filter_by].idxmax()
-        elif self._filter_mode == 'd':
-            f1, f2 = filter_by
-            return counts.loc[f1, f2].idxmax()
+        city = query.city_data
+        if isinstance(city, CityAggregates):
+            return city.duration_totals(query.filter_mode, query.filter_by)
+
+        durations = query.column('Trip Duration')
+        return durations.sum(), durations.mean()
+
+    def _duration_distribution(self, query):
+        '''
+        Helper method to retrieve the trip duration percentiles in seconds and
+        the number of trips in each histogram bin for a query. Percentiles
+        are exact for trip data and estimated from the merged log-bucket
+        histograms of the selected cells for aggregates, whose buckets are
+        then counted in the bin holding their middle.
+        '''
+        city = query.city_data
+        if isinstance(city, CityAggregates):
+            histogram = city.duration_histogram(query.filter_mode,
+                                                query.filter_by)
+            percentiles = histogram.percentiles(self._percentiles)
+            durations = histogram.bucket_middles()
+            weights = histogram.bucket_counts
+        else:
+            durations = query.column('Trip Duration').to_numpy('float64')
+            durations = durations[~np.isnan(durations)]
+            if len(durations):
+                percentiles = np.percentile(durations, self._percentiles)
+            else:
+                percentiles = np.full(len(self._percentiles), np.nan)
+            weights = None
+
+        bins = np.searchsorted(self._histogram_edges, durations, side='right')
+        bin_counts = np.bincount(bins, weights=weights,
+                                 minlength=len(self._histogram_labels))
+        return percentiles, bin_counts.astype('int64')
 
     def _convert_seconds(self, seconds):
         '''
@@ -63,81 +645,242 @@ class DataStats:
 
         return years, months, days, hours, minutes, seconds
 
-    def filter_data(self, city_name, filter_mode=None):
+    def _counts_to_dict(self, counts):
+        '''
+        Helper method to convert value counts to a dictionary, most common
+        value first, or None if nothing was counted, as for the other
+        statistics when no trips match. Categories that don't occur in the
+        data are left out.
         '''
-        Filter data for the specified city by month, day, or not at all.
+        counts = counts[counts > 0]
+        if counts.empty:
+            return None
+        return counts.sort_values(ascending=False, kind='stable').to_dict()
+
+    def cache_info(self):
+        '''
+        Return a dictionary with the number of result cache hits and misses,
+        the number of cached results and the maximum number of results.
+        '''
+        return {'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'size': len(self._result_cache),
+                'max_size': self._cache_size}
+
+    def clear_cache(self, city_name=None):
+        '''
+        Drop the cached results for a city, or for all cities if no city is
+        given.
+        '''
+        with self._lock:
+            for key in list(self._result_cache):
+                if city_name is None or key[0] == city_name:
+                    del self._result_cache[key]
+
+    def reload_city(self, city_name):
+        '''
+        Reload the data for a city, e.g. after its csv file has changed, and
+        drop its cached results and aggregates. Only data passed in as a
+        LazyCityData object can be reloaded; for a dictionary of dataframes
+        just the derived results are dropped.
+        '''
+        if hasattr(self._all_city_data, 'reload'):
+            self._all_city_data.reload(city_name)
+        # Wait for a build of the old data that is still running, so that it
+        # can't store its result after the pops
+        with self._city_lock(city_name):
+            self._city_aggregates.pop(city_name, None)
+            self._row_index.pop(city_name, None)
+        # Rows selected by any thread before the reload are no longer valid
+        self._data_versions[city_name] = \
+                self._data_versions.get(city_name, 0) + 1
+        self.clear_cache(city_name)
+
+    def trip_counts(self, city_name):
+        '''
+        Return a dataframe with the number of trips in every month (rows) and
+        weekday (columns) for the specified city.
+        '''
+        city = self._get_city_data(city_name)
+        if isinstance(city, CityAggregates):
+            return city.trip_counts()
+
+        months = city['Month'].cat.categories
+        weekdays = city['Weekday'].cat.categories
+        _, offsets = self._get_row_index(city_name, city)
+        counts = np.diff(offsets).reshape(len(months), len(weekdays), 24)
+        return pd.DataFrame(counts.sum(axis=2), index=months, columns=weekdays)
+
+    def filter_data(self, city_name, filter_mode=None, hours=None):
+        '''
+        Filter data for the specified city by month, day, date range, or not
+        at all.
 
         Parameters
 
             city_name: Name of one of the cities whose csv data was passed to
                        the DataStats constructor method.
 
-            filter_mode: 'm' for month, 'd' for day, or None to forgo filtering.
+            filter_mode: 'm' for month, 'd' for day, 'r' for date range, or
+                         None to forgo filtering. For a date range, the filter
+                         components passed to the statistic methods are the
+                         first and last day of the range, e.g.
+                         ['2017-07-01', '2017-07-04'].
+
+            hours: Optional hour range that can be combined with any filter
+                   mode: the first hour and the stop hour (exclusive), e.g.
+                   [7, 10] for trips starting from 7:00 until 9:59. A range
+                   whose stop hour is smaller than its first hour wraps
+                   around midnight.
+
+        The filter applies to the statistics asked for from the same thread
+        with filter components; a QueryPlan from the query method carries
+        its own filter instead.
         '''
-        self._filter_mode = filter_mode
-        self._city_name = city_name
+        self._filter.mode = filter_mode
+        self._filter.city = city_name
+        self._filter.hours = None
+        if hours and (hours[1] - hours[0]) % 24:
+            self._filter.hours = tuple(hours)
 
-        # Filter by month or day
-        if filter_mode:
-            self._data_is_filtered = True
-            city_data = self._all_city_data[city_name]
+        # The matching rows are selected when the first statistic is asked
+        # for, by the QueryPlan made for the filter and its components
+        self._filter.query = None
 
-            if filter_mode == 'm':
-                self._filtered_data = city_data.groupby('Month')
-            elif filter_mode == 'd':
-                self._filtered_data = city_data.groupby(['Month', 'Weekday'])
-        else:
-            self._data_is_filtered = False
-            self._filtered_data = None
+    def query(self, city_name, filter_mode=None, filter_by=None, hours=None):
+        '''
+        Make a QueryPlan for a city and filter, to be passed to any of the
+        statistic methods. Unlike filter_data this changes nothing in the
+        DataStats object, so the same QueryPlan can be used from several
+        threads and any number of queries can run at once.
+
+        Parameters
 
-    def popular_start_time(self, filter_by=None):
+            city_name: Name of one of the cities whose csv data was passed to
+                       the DataStats constructor method.
+
+            filter_mode: Filter mode, as for filter_data.
+
+            filter_by: Name of month, list containing name of month and
+                       weekday, or list containing the first and last day of
+                       a date range, depending on the filter mode.
+
+            hours: Optional hour range, as for filter_data.
+
+        Returns
+
+            query: QueryPlan holding the filter, the city data and the rows
+                   the filter selects.
         '''
-        Calculate the most popular month, day and hour for start time. Return a
-        dictionary containing values for each category. If no statistic is
-        available, 'None' will be assigned for that category.
+        if not (hours and (hours[1] - hours[0]) % 24):
+            hours = None
+        data_version = self._data_versions.get(city_name, 0)
+        city_data = self._get_city_data(city_name,
+                                        filter_mode == 'r' or bool(hours))
+
+        # The rows are found with the filter held by a QueryPlan, so the
+        # QueryPlan that is handed out is made once they are known
+        query = QueryPlan(city_name, city_data, filter_mode, filter_by, hours)
+        rows = self._select_rows(query)
+        return QueryPlan(city_name, city_data, filter_mode, filter_by, hours,
+                         rows, data_version)
+
+    def compare_cities(self, city_names, filter_mode=None, filter_by=None,
+                       hours=None, workers=None):
+        '''
+        Calculate every statistic for several cities with the same filter.
+        The cities are loaded, filtered and counted in parallel, one thread
+        per city, each with its own QueryPlan, so the current filter of the
+        calling thread is left as it is.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            city_names: Names of the cities to compare.
+
+            filter_mode: Filter mode, as for filter_data.
+
+            filter_by: Filter components, as for the statistic methods.
+
+            hours: Optional hour range, as for filter_data.
+
+            workers: Maximum number of threads (default: one per city).
 
         Returns
 
-            stats: Dictionary containing the monst popular month, day, and hour.
+            comparison: Dictionary keyed by city name, in the order of
+                        city_names, holding what all_stats returns for each
+                        city.
         '''
-        pop_start_time_labs = ['Month', 'Weekday', 'Hour']
-        pop_start_time_data = []
+        def city_stats(city_name):
+            return self.all_stats(self.query(city_name, filter_mode,
+                                             filter_by, hours))
+
+        with ThreadPoolExecutor(workers or len(city_names)) as executor:
+            return dict(zip(city_names, executor.map(city_stats, city_names)))
+
+    @cache_result
+    def all_stats(self, query=None):
+        '''
+        Calculate every statistic for a query at once. The matching
+        rows are selected a single time and each column is counted with one
+        bincount, so this is cheaper than calling the statistic methods one
+        after another.
+
+        Parameters
 
-        if self._data_is_filtered:
-            if self._filter_mode == 'm':
-                # Get pop weekday and hour
-                for col in pop_start_time_labs[1:]:
-                    pop_start_time_data.append(
-                            self._get_filtered_pop(col, filter_by))
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
-                stats = {lab: data for lab, data
-                         in zip(pop_start_time_labs[1:],
-                                pop_start_time_data)}
+        Returns
 
-            if self._filter_mode == 'd':
-                # Get pop hour
-                hr = pop_start_time_labs[-1]
-                pop_start_time_data.append(
-                        self._get_filtered_pop(hr, filter_by))
+            all_stats: Dictionary keyed by the names of the statistic methods
+                       (popular_start_time, trip_duration,
+                       duration_distribution, popular_stations,
+                       popular_trip, counts_gender, counts_user and
+                       birth_years) holding what each of them returns.
+        '''
+        # Call the undecorated methods so that the combined result is the only
+        # one that ends up in the result cache
+        return {stat_name: getattr(self, stat_name).__wrapped__(self, query)
+                for stat_name in self._stat_names}
 
-                stats = {lab: data for lab, data
-                         in zip(pop_start_time_labs[-1:],
-                                pop_start_time_data)}
+    @cache_result
+    def popular_start_time(self, query=None):
+        '''
+        Calculate the most popular month, day and hour for start time. Return a
+        dictionary containing values for each category. If no statistic is
+        available, 'None' will be assigned for that category.
 
+        Parameters
+
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
+
+        Returns
+
+            stats: Dictionary containing the monst popular month, day, and hour,
+                   or None if no trips match the filter.
+        '''
+        pop_start_time_labs = ['Month', 'Weekday', 'Hour']
+
+        # Skip the columns that are fixed by the filter
+        if query.filter_mode == 'm':
+            # Get pop weekday and hour
+            cols = pop_start_time_labs[1:]
+        elif query.filter_mode == 'd':
+            # Get pop hour
+            cols = pop_start_time_labs[-1:]
         else:
             # Get pop month, weekday, and hour
-            city = self._all_city_data[self._city_name]
-            for col in pop_start_time_labs:
-                pop_start_time_data.append(city[col].value_counts().idxmax())
+            cols = pop_start_time_labs
 
-            stats = {lab: data for lab, data
-                     in zip(pop_start_time_labs,
-                            pop_start_time_data)}
+        stats = {col: self._get_pop(col, query) for col in cols}
+        if all(stat is None for stat in stats.values()):
+            return None
 
         # Assign None to any missing values
         for lab in pop_start_time_labs:
@@ -145,204 +888,206 @@ class DataStats:
 
         return stats
 
-    def trip_duration(self, filter_by=None):
+    @cache_result
+    def trip_duration(self, query=None):
         '''
         Calculate total trip duration and average trip duration.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
             time_conv: Dictionary containing the total and average trip
-                       duration.
+                       duration, or None if no trips match the filter.
         '''
         div_labs = ['Years', 'Months', 'Days', 'Hours', 'Minutes', 'Seconds']
         time_labs = ['Total', 'Average']
         time_conv = {}
-        col = 'Trip Duration'
-
-        if self._data_is_filtered:
-            sec_mean = 0
-            sec_sum = 0
-
-            if self._filter_mode == 'm':
-                sec_mean = self._filtered_data[col].mean().loc[filter_by]
-                sec_sum = self._filtered_data[col].sum().loc[filter_by]
-            elif self._filter_mode == 'd':
-                f1, f2 = filter_by
-                sec_mean = self._filtered_data[col].mean().loc[f1, f2]
-                sec_sum = self._filtered_data[col].sum().loc[f1, f2]
-
-            for lab, seconds in zip(time_labs, [sec_sum, sec_mean]):
-                convs = self._convert_seconds(int(seconds))
-                time_tmp = {lab: conv for lab, conv
-                            in zip(div_labs, convs)}
-                time_conv[lab] = time_tmp
-        else:
-            sec_mean = self._all_city_data[self._city_name][col].mean()
-            sec_sum = self._all_city_data[self._city_name][col].sum()
+        sec_sum, sec_mean = self._duration_totals(query)
+        if pd.isna(sec_mean):
+            return None
 
-            for lab, seconds in zip(time_labs, [sec_sum, sec_mean]):
-                convs = self._convert_seconds(int(seconds))
-                time_tmp = {lab: conv for lab, conv
-                            in zip(div_labs, convs)}
-                time_conv[lab] = time_tmp
+        for lab, seconds in zip(time_labs, [sec_sum, sec_mean]):
+            convs = self._convert_seconds(int(seconds))
+            time_tmp = {lab: conv for lab, conv
+                        in zip(div_labs, convs)}
+            time_conv[lab] = time_tmp
 
         return time_conv
 
-    def popular_stations(self, filter_by=None):
+    @cache_result
+    def duration_distribution(self, query=None):
+        '''
+        Calculate the median, 90th percentile and 99th percentile trip
+        duration and a histogram of trip durations. Unlike the average, these
+        aren't thrown off by a few trips lasting days. When only aggregates
+        are used, the percentiles are estimated to within about 3%; see
+        LogHistogram.
+
+        Parameters
+
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
+
+        Returns
+
+            distribution: Dictionary containing each percentile, split into
+                          years, months, days, hours, minutes and seconds as
+                          for trip_duration, and 'Histogram', a dictionary of
+                          the number of trips in each range of durations; or
+                          None if no trips match the filter.
+        '''
+        div_labs = ['Years', 'Months', 'Days', 'Hours', 'Minutes', 'Seconds']
+        percentiles, bin_counts = self._duration_distribution(query)
+        if np.isnan(percentiles).any():
+            return None
+
+        distribution = {}
+        for lab, seconds in zip(self._percentile_labels, percentiles):
+            convs = self._convert_seconds(int(seconds))
+            distribution[lab] = {lab: conv for lab, conv
+                                 in zip(div_labs, convs)}
+        distribution['Histogram'] = dict(zip(self._histogram_labels,
+                                             bin_counts.tolist()))
+
+        return distribution
+
+    @cache_result
+    def popular_stations(self, query=None):
         '''
         Determine the most popular start and end stations.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
             pop_stations: Dictionary containing the most popular start and end
-                          stations.
+                          stations, or None if no trips match the filter.
         '''
         df_slice = ['Start Station', 'End Station']
+        pop_stations = {sl: self._get_pop(sl, query) for sl in df_slice}
+        if all(station is None for station in pop_stations.values()):
+            return None
 
-        if self._data_is_filtered:
-            pop_stations = {}
-            for sl in df_slice:
-                pop_stations[sl] = self._get_filtered_pop(sl, filter_by)
-            return pop_stations
-        else:
-            city = self._all_city_data[self._city_name]
-            return city[df_slice].apply(pd.value_counts).idxmax().to_dict()
+        return pop_stations
 
-    def popular_trip(self, filter_by=None):
+    @cache_result
+    def popular_trip(self, query=None):
         '''
         Return a dictionary containing the start and end destinations of the
         most popular trip.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
             popular_trip: Dictionary containing the start and end stations of
-                          the most popular trip
+                          the most popular trip, or None if no trips match
+                          the filter.
         '''
         labels = ['Start Station', 'End Station']
-        trip = ""
-
-        if self._data_is_filtered:
-            trip = self._get_filtered_pop('Trip', filter_by)
-        else:
-            city = self._all_city_data[self._city_name]
-            trip = city['Trip'].value_counts().idxmax()
+        trip = self._get_pop('Trip', query)
+        if trip is None:
+            return None
 
         popular_trip = {lab: street
                         for lab, street
-                        in zip(labels, trip.split("_"))}
+                        in zip(labels, trip)}
 
         return popular_trip
 
-    def counts_gender(self, filter_by=None):
+    @cache_result
+    def counts_gender(self, query=None):
         '''
         Determine the total amount of each gender for the current filter level.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
-            counts: Dictionary containing the counts for each gender.
+            counts: Dictionary containing the counts for each gender, or
+                    None if no trips match the filter.
         '''
-        if not self._check_columns_exist(['Gender']):
+        if not self._check_columns_exist(query, ['Gender']):
             return None
 
-        if self._data_is_filtered:
-            counts = self._filtered_data['Gender'].value_counts()
-            if self._filter_mode == 'm':
-                return counts.loc[filter_by].to_dict()
-            elif self._filter_mode == 'd':
-                f1, f2 = filter_by
-                return counts.loc[f1, f2].to_dict()
-        else:
-            city = self._all_city_data[self._city_name]
-            return city['Gender'].value_counts().to_dict()
+        return self._counts_to_dict(self._value_counts('Gender', query))
 
-    def counts_user(self, filter_by=None):
+    @cache_result
+    def counts_user(self, query=None):
         '''
         Determine the total amount of each user type for the current filter
         leve.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
-            counts: Dictionary containing counts for each user type.
+            counts: Dictionary containing counts for each user type, or None
+                    if no trips match the filter.
         '''
-        if not self._check_columns_exist(['User Type']):
+        if not self._check_columns_exist(query, ['User Type']):
             return None
 
-        if self._data_is_filtered:
-            counts = self._filtered_data['User Type'].value_counts()
-            if self._filter_mode == 'm':
-                return counts.loc[filter_by].to_dict()
-            elif self._filter_mode == 'd':
-                f1, f2 = filter_by
-                return counts.loc[f1, f2].to_dict()
-        else:
-            city = self._all_city_data[self._city_name]
-            return city['User Type'].value_counts().to_dict()
+        return self._counts_to_dict(self._value_counts('User Type', query))
 
-    def birth_years(self, filter_by=None):
+    @cache_result
+    def birth_years(self, query=None):
         '''
         Determine the latest, earliest, and most popular birth years for the
         current filter level.
 
         Parameters
 
-            filter_by: Name of month or list containing name of month and
-                       weekday depending on the current filter mode.
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
 
         Returns
 
             year_stats: Dictionary containing the latest, earliest, and most
-                        popular birth years.
+                        popular birth years, or None if no birth years are
+                        known for the filter.
         '''
-        if not self._check_columns_exist(['Birth Year']):
+        if not self._check_columns_exist(query, ['Birth Year']):
             return None
 
         year_types = ['Latest', 'Earliest', 'Popular']
-        years = []
-
-        if self._data_is_filtered:
-            # Get latest and earliest year
-            year_min_max = self._filtered_data['Birth Year'].agg(['min', 'max'])
-            if self._filter_mode == 'm':
-                years.extend(list(year_min_max.loc[filter_by]))
-            elif self._filter_mode == 'd':
-                f1, f2 = filter_by
-                years.extend(list(year_min_max.loc[f1, f2]))
-
-            # Get most popular year
-            years.append(self._get_filtered_pop('Birth Year', filter_by))
-        else:
-            city = self._all_city_data[self._city_name]
-
-            # Get latest and earliest year
-            years.extend(list(city['Birth Year'].agg(['min', 'max'])))
+        counts = self._value_counts('Birth Year', query)
+        counts = counts[counts > 0]
+        if not len(counts):
+            return None
 
-            # Get most popular year
-            years.append(city['Birth Year'].value_counts().idxmax())
+        # Get latest and earliest year, then most popular year
+        years = [counts.index.min(), counts.index.max(), counts.idxmax()]
 
         # Combine year_types and years into dict
         year_stats = {year_type: int(year)
@@ -350,3 +1095,50 @@ class DataStats:
                       in zip(year_types, years)}
 
         return year_stats
+
+    @cache_result
+    def top_stations(self, query=None, k=10):
+        '''
+        Determine the k most popular start and end stations.
+
+        Parameters
+
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
+
+            k: Number of stations to rank.
+
+        Returns
+
+            top_stations: Dictionary containing a list of (station, number of
+                          trips) pairs, most popular first, for the start and
+                          for the end stations.
+        '''
+        df_slice = ['Start Station', 'End Station']
+
+        return {sl: list(self._top_counts(sl, query, k).items())
+                for sl in df_slice}
+
+    @cache_result
+    def top_trips(self, query=None, k=10):
+        '''
+        Determine the k most popular trips.
+
+        Parameters
+
+            query: QueryPlan returned by the query method, or the filter
+                   components for the filter set by filter_data: name of
+                   month, list containing name of month and weekday, or list
+                   containing the first and last day of a date range.
+
+            k: Number of trips to rank.
+
+        Returns
+
+            top_trips: List of (start station, end station, number of trips)
+                       tuples, most popular first.
+        '''
+        return [(start, end, count) for (start, end), count
+                in self._top_counts('Trip', query, k).items()]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+#   load_test.py - sends random queries from several clients at once to the
+#   query server of bikeshare.py and reports the latency and throughput seen
+#   by the clients and by the server.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import calendar as cal
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import numpy as np
+from urllib.parse import urlencode
+
+_months = cal.month_name[1:]
+_weekdays = list(cal.day_name)
+
+
+def get_json(url, timeout=60):
+    '''
+    Send a GET request and return the HTTP status code and the decoded JSON
+    answer.
+    '''
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as err:
+        return err.code, json.load(err)
+
+
+def random_query(rng, city_names):
+    '''
+    Return the endpoint and query parameters of a random query: mostly
+    statistics for one city, sometimes the top stations and trips or a
+    comparison of all cities, filtered by month, day, dates and hours.
+    '''
+    endpoint = rng.choices(['/stats', '/top', '/compare'], [0.7, 0.2, 0.1])[0]
+    if endpoint == '/compare':
+        params = {'cities': 'all'}
+    else:
+        params = {'city': rng.choice(city_names)}
+    if endpoint == '/top':
+        params['k'] = rng.choice([5, 10, 20])
+
+    filter_mode = rng.choice([None, 'm', 'd', 'r'])
+    if filter_mode in ['m', 'd']:
+        params['month'] = rng.choice(_months)
+    if filter_mode == 'd':
+        params['weekday'] = rng.choice(_weekdays)
+    if filter_mode == 'r':
+        first_day = rng.randrange(1, 25)
+        params['first_day'] = '2017-{:02d}-{:02d}'.format(rng.randrange(1, 13),
+                                                         first_day)
+        params['last_day'] = params['first_day'][:8] + '{:02d}'.format(
+                first_day + rng.randrange(0, 5))
+    if rng.random() < 0.3:
+        first_hour = rng.randrange(24)
+        params['hours'] = '{}-{}'.format(first_hour,
+                                         (first_hour + rng.randrange(1, 6)) % 24)
+
+    return endpoint, params
+
+
+def run_clients(base_url, num_clients, duration, seed):
+    '''
+    Send random queries from num_clients threads, each waiting for its answer
+    before sending the next, for duration seconds. Returns a list of
+    (endpoint, status, seconds) tuples, one per request.
+    '''
+    _, answer = get_json(base_url + '/cities')
+    city_names = answer['cities']
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(client_num):
+        rng = random.Random(seed + client_num)
+        while time.perf_counter() < deadline:
+            endpoint, params = random_query(rng, city_names)
+            start = time.perf_counter()
+            status, _ = get_json(base_url + endpoint + '?' + urlencode(params))
+            elapsed = time.perf_counter() - start
+            with lock:
+                results.append((endpoint, status, elapsed))
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def print_report(results, duration, server_metrics):
+    '''
+    Print the throughput and the latency percentiles of every endpoint as
+    seen by the clients, followed by the server's own metrics.
+    '''
+    errors = sum(1 for _, status, _ in results if status >= 400)
+    print("{:,} requests in {:.1f} s: {:.1f} requests/s, {} errors".format(
+            len(results), duration, len(results) / duration, errors))
+
+    print("\n{:<10} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            'Endpoint', 'Requests', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for endpoint in sorted({endpoint for endpoint, _, _ in results}):
+        latencies = np.array([seconds for e, _, seconds in results
+                              if e == endpoint]) * 1000
+        print("{:<10} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                endpoint, len(latencies),
+                *np.percentile(latencies, [50, 90, 99]), latencies.max()))
+
+    print("\nServer metrics:")
+    print(json.dumps(server_metrics, indent=2))
+
+
+def free_port():
+    '''
+    Return a TCP port on localhost that nothing is listening on.
+    '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(data_dir, threads, extra_args):
+    '''
+    Start bikeshare.py as a query server in the directory with the csv files
+    and wait until it answers. Returns the process and the server URL.
+    '''
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'bikeshare.py')
+    process = subprocess.Popen([sys.executable, script, '--serve', str(port),
+                                '--threads', str(threads), *extra_args],
+                               cwd=data_dir)
+    base_url = 'http://127.0.0.1:{}'.format(port)
+
+    while True:
+        if process.poll() is not None:
+            sys.exit("The server exited with code {}".format(process.returncode))
+        try:
+            get_json(base_url + '/cities', timeout=1)
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Load test the bike share query server.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080',
+                        help="URL of a running server (default: %(default)s)")
+    parser.add_argument('--data-dir',
+                        help="instead of using a running server, start one in "
+                             "this directory of csv files")
+    parser.add_argument('--server-threads', type=int, default=8,
+                        help="threads of the started server")
+    parser.add_argument('--server-args', default='',
+                        help="more options for the started server, given "
+                             "with an equals sign since they start with a "
+                             "dash, e.g. "
+                             "--server-args='--precompute --column-store'")
+    parser.add_argument('--clients', type=int, default=8,
+                        help="number of clients sending queries at once")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to send queries for")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the random queries")
+    args = parser.parse_args()
+
+    process = None
+    base_url = args.url.rstrip('/')
+    if args.data_dir:
+        process, base_url = start_server(args.data_dir, args.server_threads,
+                                         args.server_args.split())
+
+    try:
+        # Load every city before timing so that startup isn't measured
+        get_json(base_url + '/compare?cities=all', timeout=600)
+
+        start = time.perf_counter()
+        results = run_clients(base_url, args.clients, args.duration, args.seed)
+        duration = time.perf_counter() - start
+        _, server_metrics = get_json(base_url + '/metrics')
+        print_report(results, duration, server_metrics)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
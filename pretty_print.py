@@ -18,6 +18,7 @@ class PrettyPrint:
         self._city_name = None
         self._filter_mode = None
         self._filter_by = None
+        self._hours = None
 
     def _fancy_header_main(self, header_strings):
         '''
@@ -73,6 +74,26 @@ class PrettyPrint:
             else:
                 print("{}: {}".format(time, stat), end=' | ')
 
+    def _print_ranked_table(self, col_names, rows):
+        '''
+        Helper method to print rows as a table with a rank column. The last
+        column holds counts and is right-aligned.
+        '''
+        rows = [[str(i)] + [str(value) for value in row[:-1]] +
+                ['{:,}'.format(row[-1])] for i, row in enumerate(rows, 1)]
+        col_names = ['Rank'] + col_names
+        widths = [max([len(col_name)] + [len(row[j]) for row in rows])
+                  for j, col_name in enumerate(col_names)]
+
+        print()
+        for row in [col_names] + rows:
+            cells = ['{:>{w}}'.format(row[0], w=widths[0])]
+            cells += ['{:<{w}}'.format(value, w=w)
+                      for value, w in zip(row[1:-1], widths[1:-1])]
+            cells.append('{:>{w}}'.format(row[-1], w=widths[-1]))
+            print('  '.join(cells))
+        print()
+
     def main_header(self):
         '''
         Print a header displaying the current filter options: city, filter mode,
@@ -80,19 +101,28 @@ class PrettyPrint:
         '''
         str_title = 'Statistics for {}'.format(self._city_name)
         all_filter_str = [str_title]
-        if self._filter_mode:
+        if self._filter_mode or self._hours:
             str_filter_header = 'Filtered by'
             str_filter_comp = []
             if self._filter_mode == 'd':
                 month, day = self._filter_by
                 str_filter_comp.append('Month: {}'.format(month))
                 str_filter_comp.append('Day: {}'.format(day))
-            else:
+            elif self._filter_mode == 'r':
+                first_day, last_day = self._filter_by
+                str_filter_comp.append('Dates: {} to {}'.format(first_day,
+                                                                last_day))
+            elif self._filter_mode == 'm':
                 str_filter_comp.append('Month: {}'.format(self._filter_by))
+            if self._hours:
+                first_hour, stop_hour = self._hours
+                str_filter_comp.append('Hours: {}:00 to {}:59'.format(
+                        first_hour, (stop_hour - 1) % 24))
             all_filter_str = [str_title, str_filter_header, *str_filter_comp]
         self._fancy_header_main(all_filter_str)
 
-    def get_filter_options(self, city_name, filter_mode=None, filter_by=None):
+    def get_filter_options(self, city_name, filter_mode=None, filter_by=None,
+                           hours=None):
         '''
         Get the current filter options and assign them to the proper internal
         variables.
@@ -102,16 +132,21 @@ class PrettyPrint:
             city_name: Name of city as a string. Should match the names of one
                        of the cities stored in a DataStats object.
 
-            filter_mode: 'm' for month', 'd' for day, and None to forgo
-                         filtering.
+            filter_mode: 'm' for month', 'd' for day, 'r' for date range, and
+                         None to forgo filtering.
 
             filter_by: Name of the month as a string for filter mode 'm', a list
                        containing the name of the month and day of week for
-                       filter mode 'd'. None if data was not filtered.
+                       filter mode 'd', a list containing the first and last
+                       day for filter mode 'r'. None if data was not filtered.
+
+            hours: List containing the first hour and the stop hour
+                   (exclusive) of an hour range, or None for all hours.
         '''
         self._city_name = city_name
         self._filter_mode = filter_mode
         self._filter_by = filter_by
+        self._hours = hours
 
     def show_start_time_stats(self, start_time_stats=None):
         '''
@@ -216,6 +251,47 @@ class PrettyPrint:
         else:
             print("\nThere was no data for these particular statistics.\n")
 
+    def show_duration_distribution_stats(self, duration_distribution=None):
+        '''
+        Display the trip duration percentiles and a histogram of trip
+        durations for the current filter options.
+
+        Parameters
+
+            duration_distribution: Dictionary containing the trip duration
+                                   percentiles and histogram, as returned by
+                                   DataStats.duration_distribution.
+        '''
+        header = 'Trip Duration Percentiles and Histogram'
+        self._fancy_header_stat_group(header)
+
+        if not duration_distribution:
+            print("\nThere was no data for these particular statistics.\n")
+            return
+
+        histogram = duration_distribution['Histogram']
+        percentiles = {label: duration for label, duration
+                       in duration_distribution.items()
+                       if label != 'Histogram'}
+        label_width = max(len(label) for label in [*percentiles, *histogram])
+
+        print()
+        for label, duration in percentiles.items():
+            print('{:<{w}}  {}'.format(label, self._format_duration(duration),
+                                       w=label_width))
+
+        # One bar per bin, scaled so that the largest bin is 40 characters
+        print()
+        total = sum(histogram.values())
+        largest = max(histogram.values())
+        count_width = len('{:,}'.format(largest))
+        for label, count in histogram.items():
+            bar = '#' * round(40 * count / largest) if largest else ''
+            print('{:<{w}}  {:>{cw},}  {:>5.1%}  {}'.format(
+                    label, count, count / total if total else 0, bar,
+                    w=label_width, cw=count_width).rstrip())
+        print()
+
     def show_user_count_stats(self, user_count_stats=None):
         '''
         Display totals for each user type for the current filter options.
@@ -265,3 +341,155 @@ class PrettyPrint:
             self._print_stats_from_dict(birth_year_stats)
         else:
             print("\nThere was no data for these particular statistics.\n")
+
+    def show_top_stations(self, top_stations=None):
+        '''
+        Display ranked tables of the most popular start and end stations for
+        the current filter options.
+
+        Parameters
+
+            top_stations: Dictionary containing a list of (station, number of
+                          trips) pairs for the start and for the end stations,
+                          as returned by DataStats.top_stations.
+        '''
+        for station_type, ranking in (top_stations or {}).items():
+            header = 'Top {} {}s'.format(len(ranking), station_type)
+            self._fancy_header_stat_group(header)
+            self._print_ranked_table([station_type, 'Trips'], ranking)
+
+        if not top_stations:
+            self._fancy_header_stat_group('Top Stations')
+            print("\nThere was no data for these particular statistics.\n")
+
+    def show_top_trips(self, top_trips=None):
+        '''
+        Display a ranked table of the most popular trips for the current filter
+        options.
+
+        Parameters
+
+            top_trips: List of (start station, end station, number of trips)
+                       tuples, as returned by DataStats.top_trips.
+        '''
+        if top_trips:
+            self._fancy_header_stat_group('Top {} Trips'.format(len(top_trips)))
+            self._print_ranked_table(['Start Station', 'End Station', 'Trips'],
+                                     top_trips)
+        else:
+            self._fancy_header_stat_group('Top Trips')
+            print("\nThere was no data for these particular statistics.\n")
+
+    def _format_duration(self, duration):
+        '''
+        Helper method to format a trip duration, as a dictionary of years,
+        months, days, hours, minutes and seconds, on one line, e.g.
+        '1 mo 11 d 4:27:37'.
+        '''
+        parts = ['{} {}'.format(duration[unit], abbrev)
+                 for unit, abbrev in [('Years', 'y'), ('Months', 'mo'),
+                                      ('Days', 'd')]
+                 if duration[unit]]
+        parts.append('{}:{:02}:{:02}'.format(duration['Hours'],
+                                             duration['Minutes'],
+                                             duration['Seconds']))
+        return ' '.join(parts)
+
+    def _print_comparison_table(self, city_names, rows):
+        '''
+        Helper method to print rows of values side by side with one column per
+        city. Each row is a label and a list of values, one per city. Rows
+        without any values are left out and missing values are shown as '-'.
+        Counts are right-aligned.
+        '''
+        rows = [(label, values) for label, values in rows
+                if any(value is not None for value in values)]
+        if not rows:
+            print("\nThere was no data for these particular statistics.\n")
+            return
+
+        cells = [[''] + list(city_names)]
+        cells += [[str(label)] + ['-' if value is None else
+                                  '{:,}'.format(value)
+                                  if isinstance(value, int) else str(value)
+                                  for value in values]
+                  for label, values in rows]
+        widths = [max(len(row[j]) for row in cells)
+                  for j in range(len(cells[0]))]
+
+        print()
+        for row, (_, values) in zip(cells, [(None, city_names)] + rows):
+            line = ['{:<{w}}'.format(row[0], w=widths[0])]
+            line += ['{:>{w}}'.format(cell, w=w) if isinstance(value, int)
+                     else '{:<{w}}'.format(cell, w=w)
+                     for cell, value, w in zip(row[1:], values, widths[1:])]
+            print('   '.join(line).rstrip())
+        print()
+
+    def show_comparison(self, comparison=None):
+        '''
+        Display the statistics of several cities side by side for the current
+        filter options.
+
+        Parameters
+
+            comparison: Dictionary keyed by city name holding the statistics
+                        of each city, as returned by DataStats.compare_cities.
+        '''
+        if not comparison:
+            self._fancy_header_stat_group('Comparison')
+            print("\nThere was no data for these particular statistics.\n")
+            return
+
+        city_names = list(comparison)
+        all_stats = list(comparison.values())
+
+        def stat_rows(stat_name, labels=None, format_value=None, part=None):
+            city_dicts = [stats[stat_name] or {} for stats in all_stats]
+            if part:
+                # A dictionary nested in the statistic, e.g. a histogram
+                city_dicts = [city_dict.get(part) or {}
+                              for city_dict in city_dicts]
+            if labels is None:
+                # Every value counted in any of the cities, e.g. user types
+                labels = []
+                for city_dict in city_dicts:
+                    labels += [label for label in city_dict
+                               if label not in labels]
+
+            rows = []
+            for label in labels:
+                values = [city_dict.get(label) for city_dict in city_dicts]
+                if format_value:
+                    values = [None if value is None else format_value(value)
+                              for value in values]
+                rows.append((label, values))
+            return rows
+
+        stations = ['Start Station', 'End Station']
+        stat_groups = [
+            ('Popular Month, Day, and Hour for Start Time',
+             stat_rows('popular_start_time', ['Month', 'Weekday']) +
+             stat_rows('popular_start_time', ['Hour'], '{}:00'.format)),
+            ('Popular Start and End Stations',
+             stat_rows('popular_stations', stations)),
+            ('Most Popular Trip', stat_rows('popular_trip', stations)),
+            ('Total and Average Trip Duration',
+             stat_rows('trip_duration', ['Total', 'Average'],
+                       self._format_duration)),
+            ('Trip Duration Percentiles',
+             stat_rows('duration_distribution',
+                       ['Median', '90th Percentile', '99th Percentile'],
+                       self._format_duration)),
+            ('Histogram of Trip Durations',
+             stat_rows('duration_distribution', None, int, 'Histogram')),
+            ('Counts of each User Type', stat_rows('counts_user', None, int)),
+            ('Counts of each Gender', stat_rows('counts_gender', None, int)),
+            ('Latest, Earliest, and most Popular Birth Years',
+             stat_rows('birth_years', ['Latest', 'Earliest', 'Popular'],
+                       str)),
+        ]
+
+        for header, rows in stat_groups:
+            self._fancy_header_stat_group(header)
+            self._print_comparison_table(city_names, rows)
@@ -0,0 +1,160 @@
+#
+#   profiling.py - Contains the Profiler class that times the stages of a
+#   query and can record cProfile dumps of them.
+#
+
+import os
+import sys
+import time
+import cProfile
+import threading
+import functools
+import contextlib
+
+# Returned by Profiler.stage when profiling is off
+_null_stage = contextlib.nullcontext()
+
+
+class Profiler:
+    '''
+    A class for timing the stages of each query: loading, filtering, every
+    statistic and printing. Methods of other objects are timed by replacing
+    them with timed wrappers, which only happens when profiling is on, so a
+    disabled profiler costs next to nothing.
+    '''
+
+    def __init__(self, enabled=False, dump_dir=None):
+        '''
+        Initialize Profiler object.
+
+        Parameters
+
+            enabled: If False, nothing is timed or printed.
+
+            dump_dir: Optional directory that a cProfile dump of each query is
+                      written to, as a pstats file.
+        '''
+        self.enabled = enabled
+        self._dump_dir = dump_dir
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._cprofile = None
+        self._num_queries = 0
+
+    @contextlib.contextmanager
+    def _timed_stage(self, name):
+        '''
+        Helper method to time a stage and add it to the current query.
+        '''
+        # Stages are listed in the order they start in
+        with self._lock:
+            self._timings.setdefault(name, (0, 0.0))
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                calls, seconds = self._timings.get(name, (0, 0.0))
+                self._timings[name] = (calls + 1, seconds + elapsed)
+
+    def stage(self, name):
+        '''
+        Return a context manager that times the code run inside it as the
+        named stage.
+        '''
+        if not self.enabled:
+            return _null_stage
+        return self._timed_stage(name)
+
+    def _timed(self, name, func):
+        '''
+        Helper method to wrap a function so that every call is timed as the
+        named stage. A wrapped function's undecorated version (__wrapped__) is
+        timed too, so statistics that bypass the result cache still show up.
+        '''
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            with self._timed_stage(name):
+                return func(*args, **kwargs)
+
+        raw_func = getattr(func, '__wrapped__', None)
+        if raw_func is not None:
+            timed_func.__wrapped__ = self._timed(name, raw_func)
+        return timed_func
+
+    def instrument(self, obj, method_names):
+        '''
+        Time every call of the given methods of an object. Does nothing if
+        profiling is off.
+
+        Parameters
+
+            obj: Object whose methods are timed, e.g. a DataStats object.
+
+            method_names: Names of the methods. Each is reported as the class
+                          name followed by the method name.
+        '''
+        if not self.enabled:
+            return
+
+        for method_name in method_names:
+            name = '{}.{}'.format(type(obj).__name__, method_name)
+            setattr(obj, method_name,
+                    self._timed(name, getattr(obj, method_name)))
+
+    def start_query(self):
+        '''
+        Start timing a new query. If a dump directory was given, the query is
+        also run under cProfile.
+        '''
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._timings = {}
+        if self._dump_dir:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def end_query(self, label, out_file=None):
+        '''
+        Stop timing the current query and print the time spent in each stage.
+        Times of stages include the stages nested inside them.
+
+        Parameters
+
+            label: Description of the query printed above the timings.
+
+            out_file: File the timings are printed to (default: standard
+                      error).
+        '''
+        if not self.enabled:
+            return
+
+        out_file = out_file or sys.stderr
+        self._num_queries += 1
+        if self._cprofile:
+            self._cprofile.disable()
+            os.makedirs(self._dump_dir, exist_ok=True)
+            dump_file = os.path.join(self._dump_dir, 'query-{:04d}.pstats'
+                                     .format(self._num_queries))
+            self._cprofile.dump_stats(dump_file)
+            self._cprofile = None
+
+        with self._lock:
+            timings = list(self._timings.items())
+
+        print("\nTimings for {}:".format(label), file=out_file)
+        print("  {:<36} {:>6} {:>12}".format('Stage', 'Calls', 'Total ms'),
+              file=out_file)
+        for name, (calls, seconds) in timings:
+            # Stages still running in another thread, such as background
+            # loading, haven't finished a call yet
+            total = '{:.3f}'.format(seconds * 1000) if calls else 'running'
+            print("  {:<36} {:>6} {:>12}".format(name, calls, total),
+                  file=out_file)
+        if self._dump_dir:
+            print("  cProfile dump written to {}".format(dump_file),
+                  file=out_file)
@@ -0,0 +1,371 @@
+#
+#   query_server.py - Contains the QueryServer class that answers statistic
+#   queries over HTTP with JSON, and the ServerMetrics class that keeps track
+#   of its latency and throughput.
+#
+
+import time
+import threading
+import collections
+import numpy as np
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import bikeshare_functions as bike_funs
+
+
+class ServerMetrics:
+    '''
+    A class for counting the requests of each endpoint and keeping their
+    latencies. Percentiles are computed over the most recent requests only,
+    so they follow changes in load.
+    '''
+
+    def __init__(self, window=1000):
+        '''
+        Initialize ServerMetrics object.
+
+        Parameters
+
+            window: Number of recent requests of each endpoint whose latencies
+                    are kept for the percentiles.
+        '''
+        self._lock = threading.Lock()
+        self._window = window
+        self._started = time.monotonic()
+        self._in_flight = 0
+        self._requests = collections.Counter()
+        self._errors = collections.Counter()
+        self._latencies = collections.defaultdict(
+                lambda: collections.deque(maxlen=self._window))
+        self._finish_times = collections.deque(maxlen=window)
+
+    def start_request(self):
+        '''
+        Count a request that has been received but not answered yet.
+        '''
+        with self._lock:
+            self._in_flight += 1
+
+    def finish_request(self, endpoint, seconds, status):
+        '''
+        Record an answered request.
+
+        Parameters
+
+            endpoint: Path of the endpoint, e.g. '/stats'.
+
+            seconds: Time taken to answer the request.
+
+            status: HTTP status code of the answer. Codes of 400 and above
+                    are counted as errors.
+        '''
+        with self._lock:
+            self._in_flight -= 1
+            self._requests[endpoint] += 1
+            if status >= 400:
+                self._errors[endpoint] += 1
+            self._latencies[endpoint].append(seconds)
+            self._finish_times.append(time.monotonic())
+
+    def snapshot(self):
+        '''
+        Return a dictionary with the uptime, the requests in flight, the
+        overall and recent throughput in requests per second, and the number
+        of requests and errors and the latency percentiles in milliseconds of
+        every endpoint.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            uptime = now - self._started
+            finish_times = list(self._finish_times)
+            endpoints = {endpoint: (self._requests[endpoint],
+                                    self._errors[endpoint],
+                                    np.array(self._latencies[endpoint]))
+                         for endpoint in self._requests}
+            in_flight = self._in_flight
+
+        # Throughput over the last minute, or since the oldest request kept
+        recent = [t for t in finish_times if t >= now - 60]
+        recent_span = min(60, now - finish_times[0]) if finish_times else 0
+        total_requests = sum(count for count, _, _ in endpoints.values())
+
+        metrics = {
+            'uptime_seconds': round(uptime, 3),
+            'in_flight': in_flight,
+            'requests': total_requests,
+            'requests_per_second': round(total_requests / uptime, 3)
+                                   if uptime else 0,
+            'recent_requests_per_second': round(len(recent) / recent_span, 3)
+                                          if recent_span else 0,
+            'endpoints': {},
+        }
+        for endpoint, (count, errors, latencies) in sorted(endpoints.items()):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+            metrics['endpoints'][endpoint] = {
+                'requests': count,
+                'errors': errors,
+                'latency_ms': {'p50': round(p50, 3), 'p90': round(p90, 3),
+                               'p99': round(p99, 3),
+                               'max': round(latencies.max() * 1000, 3)},
+            }
+        return metrics
+
+
+class _PooledHTTPServer(HTTPServer):
+    '''
+    An HTTPServer that handles each connection in a fixed pool of worker
+    threads, so a slow query only holds up one worker.
+    '''
+
+    def __init__(self, address, handler_class, threads):
+        super().__init__(address, handler_class)
+        self._executor = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler that passes GET requests on to the QueryServer.
+    '''
+    server_version = 'BikeshareQueryServer/1.0'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {name: values[-1]
+                  for name, values in parse_qs(url.query).items()}
+        status, body = self.server.query_server.handle(url.path, params)
+
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.query_server.verbose:
+            super().log_message(format, *args)
+
+
+class QueryServer:
+    '''
+    A class for answering statistic queries over HTTP while the data of every
+    city stays loaded. Requests are handled by a pool of threads, each
+    answering its own DataStats QueryPlan from the shared data, so queries
+    for different cities or filters run side by side. Every answer is a JSON
+    object.
+
+    Endpoints, all answering GET requests:
+
+        /cities: The names of the cities.
+
+        /stats: Every statistic for one city, in the layout of a JSON Lines
+                batch report record.
+
+        /top: The k most popular stations and trips of one city.
+
+        /compare: Every statistic for several cities.
+
+        /metrics: Latency and throughput of the server; see ServerMetrics.
+
+    The filter is given as query parameters: city (or cities, separated by
+    commas, for /compare), and optionally month, weekday (with month),
+    first_day and last_day, hours (e.g. 7-10) and k (for /top).
+    '''
+
+    def __init__(self, data_stats_obj, validator_obj, city_names,
+                 host='127.0.0.1', port=8080, threads=8, verbose=False):
+        '''
+        Initialize QueryServer object and bind it to its address. Requests are
+        answered once serve_forever is called.
+
+        Parameters
+
+            data_stats_obj: DataStats object holding the data of every city.
+
+            validator_obj: Validate object used to check query parameters.
+
+            city_names: List of city names.
+
+            host: Address to listen on. The default only accepts requests
+                  from the same machine.
+
+            port: Port to listen on, or 0 to pick a free port.
+
+            threads: Number of worker threads answering requests.
+
+            verbose: If True, log every request to standard error.
+        '''
+        self._data_stats = data_stats_obj
+        self._validator = validator_obj
+        self._city_names = list(city_names)
+        self.verbose = verbose
+        self.metrics = ServerMetrics()
+        self._endpoints = {'/cities': self._get_cities,
+                           '/stats': self._get_stats,
+                           '/top': self._get_top,
+                           '/compare': self._get_comparison,
+                           '/metrics': self._get_metrics}
+
+        self._http_server = _PooledHTTPServer((host, port), _QueryHandler,
+                                              threads)
+        self._http_server.query_server = self
+
+    @property
+    def address(self):
+        '''
+        Host and port the server is listening on.
+        '''
+        return self._http_server.server_address[:2]
+
+    def serve_forever(self):
+        '''
+        Answer requests until shutdown is called from another thread.
+        '''
+        self._http_server.serve_forever()
+
+    def shutdown(self):
+        '''
+        Stop serve_forever and close the server once the requests in progress
+        have been answered.
+        '''
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+    def handle(self, path, params):
+        '''
+        Answer a request. Returns the HTTP status code and the JSON body.
+
+        Parameters
+
+            path: Path of the request, naming the endpoint.
+
+            params: Dictionary of the query parameters.
+        '''
+        start = time.perf_counter()
+        self.metrics.start_request()
+        endpoint = path if path in self._endpoints else 'other'
+        try:
+            if endpoint == 'other':
+                status, result = 404, {'error': "Unknown endpoint: " + path}
+            else:
+                status, result = 200, self._endpoints[path](params)
+        except ValueError as err:
+            # Bad query parameters, or a filter the loaded data can't answer
+            status, result = 400, {'error': str(err)}
+        except Exception as err:
+            status, result = 500, {'error': repr(err)}
+
+        body = bike_funs.to_json(result)
+        self.metrics.finish_request(endpoint, time.perf_counter() - start,
+                                    status)
+        return status, body
+
+    def _match_city(self, params):
+        '''
+        Helper method to get the city name given by the city parameter.
+        '''
+        city_name = self._validator.match_city(params.get('city', ''),
+                                               self._city_names)
+        if not city_name:
+            raise ValueError("Unknown or missing city: {!r}".format(
+                    params.get('city')))
+        return city_name
+
+    def _match_cities(self, params):
+        '''
+        Helper method to get the city names given by the cities parameter,
+        separated by commas, or every city for 'all'.
+        '''
+        city_names = self._validator.match_cities(params.get('cities', ''),
+                                                  self._city_names)
+        if not city_names:
+            raise ValueError("Unknown or missing cities: {!r}".format(
+                    params.get('cities')))
+        return city_names
+
+    def _filter_options(self, params, filter_city):
+        '''
+        Helper method to turn query parameters into filter options like the
+        ones returned by bikeshare_functions.get_filter_options.
+        '''
+        def match(name, match_value):
+            value = match_value(params[name])
+            if not value:
+                raise ValueError("Invalid {}: {!r}".format(name, params[name]))
+            return value
+
+        hours = match('hours', self._validator.match_hour_range) \
+                if 'hours' in params else None
+
+        if 'first_day' in params:
+            dates = params['first_day'] + ' ' + params.get('last_day', '')
+            filter_comp = self._validator.match_date_range(dates)
+            if not filter_comp:
+                raise ValueError("Invalid date range: {!r}".format(dates))
+            return [filter_city, 'r', filter_comp, hours]
+        elif 'weekday' in params:
+            if 'month' not in params:
+                raise ValueError("A weekday needs a month")
+            return [filter_city, 'd',
+                    [match('month', self._validator.match_month),
+                     match('weekday', self._validator.match_day)], hours]
+        elif 'month' in params:
+            return [filter_city, 'm',
+                    match('month', self._validator.match_month), hours]
+        return [filter_city, None, None, hours]
+
+    def _get_cities(self, params):
+        return {'cities': self._city_names}
+
+    def _get_stats(self, params):
+        filter_city = self._match_city(params)
+        filter_options = self._filter_options(params, filter_city)
+        all_stats = bike_funs.calculate_stats(self._data_stats, filter_options)
+        return bike_funs.query_record(filter_options, all_stats)
+
+    def _get_top(self, params):
+        filter_city = self._match_city(params)
+        filter_options = self._filter_options(params, filter_city)
+        try:
+            k = int(params.get('k', 10))
+        except ValueError:
+            raise ValueError("Invalid k: {!r}".format(params['k']))
+        if k < 1:
+            raise ValueError("k must be at least 1")
+
+        top_stations, top_trips = bike_funs.calculate_top(
+                self._data_stats, filter_options, k)
+        record = bike_funs.query_fields(filter_options)
+        record.update({'top_stations': top_stations, 'top_trips': top_trips})
+        return record
+
+    def _get_comparison(self, params):
+        filter_cities = self._match_cities(params)
+        filter_options = self._filter_options(params, filter_cities)
+        comparison = bike_funs.calculate_comparison(self._data_stats,
+                                                    filter_options)
+        return {city: bike_funs.query_record(
+                        [city] + filter_options[1:],
+                        bike_funs.order_stats(stats))
+                for city, stats in comparison.items()}
+
+    def _get_metrics(self, params):
+        metrics = self.metrics.snapshot()
+        metrics['result_cache'] = self._data_stats.cache_info()
+        return metrics
@@ -0,0 +1,232 @@
+#
+#   sketches.py - Contains the HeavyHitters class, a mergeable summary of the
+#   most frequent values in a stream that uses a bounded amount of memory, and
+#   the LogHistogram class, a mergeable summary of the distribution of
+#   positive values such as trip durations.
+#
+
+import numpy as np
+import pandas as pd
+
+
+class HeavyHitters:
+    '''
+    A class for finding the most frequent values in a stream with bounded
+    memory, using the Misra-Gries summary (the counter-based summary that
+    Space-Saving also keeps, stored as lower rather than upper bounds). At most
+    1 / error_bound counters are kept. Every estimated count is at most
+    error_bound times the number of values seen below the true count, and any
+    value whose true count exceeds that bound is kept. Summaries built from
+    different chunks or processes can be merged with the same guarantee.
+    '''
+
+    def __init__(self, error_bound=0.001):
+        '''
+        Initialize an empty HeavyHitters object.
+
+        Parameters
+
+            error_bound: Largest error of an estimated count, as a fraction of
+                         the number of values seen. Must be between 0 and 1.
+        '''
+        if not 0 < error_bound < 1:
+            raise ValueError("error_bound must be between 0 and 1")
+
+        self.error_bound = error_bound
+        self.capacity = int(np.ceil(1 / error_bound))
+        self.total = 0
+        self.max_error = 0
+        self._counts = None
+
+    def _prune(self, counts):
+        '''
+        Helper method to keep at most capacity counters: the count of the
+        (capacity + 1)-th most frequent value is subtracted from every counter
+        and counters that drop to 0 are removed.
+        '''
+        if len(counts) > self.capacity:
+            values = counts.to_numpy()
+            cut_rank = len(values) - self.capacity - 1
+            cut = np.partition(values, cut_rank)[cut_rank]
+            counts = counts - cut
+            counts = counts[counts > 0]
+            self.max_error += int(cut)
+
+        self._counts = counts
+
+    def update(self, counts):
+        '''
+        Add a batch of values to the summary.
+
+        Parameters
+
+            counts: Series of exact counts indexed by value, e.g. the value
+                    counts of one chunk of data.
+        '''
+        counts = counts[counts > 0].astype('int64')
+        self.total += int(counts.sum())
+        if self._counts is not None and len(self._counts):
+            counts = pd.concat([self._counts, counts])
+            counts = counts.groupby(level=list(range(counts.index.nlevels)),
+                                    sort=False).sum()
+        self._prune(counts)
+
+    def merge(self, *others):
+        '''
+        Add the values summarized by other HeavyHitters objects to this one.
+        The result is as accurate as a summary built from all values at once.
+        '''
+        for other in others:
+            self.total += other.total
+            self.max_error += other.max_error
+
+        all_counts = [sketch._counts for sketch in (self, *others)
+                      if sketch._counts is not None and len(sketch._counts)]
+        if all_counts:
+            counts = pd.concat(all_counts)
+            counts = counts.groupby(level=list(range(counts.index.nlevels)),
+                                    sort=False).sum()
+            self._prune(counts)
+
+    def counts(self):
+        '''
+        Return a series of the estimated counts of the kept values, indexed by
+        value. Each estimate is at most max_error below the true count; values
+        that aren't included occurred at most max_error times.
+        '''
+        if self._counts is None:
+            return pd.Series([], dtype='int64')
+        return self._counts.copy()
+
+
+class LogHistogram:
+    '''
+    A class for summarizing the distribution of positive values, such as trip
+    durations, by counting them in fixed buckets whose bounds grow by the same
+    factor, so every bucket is equally wide relative to the values in it. A
+    percentile is estimated as the geometric middle of the bucket it falls in,
+    which is within relative_error of the true value for values between
+    min_value and max_value; smaller and larger values are counted in one
+    bucket each. Histograms with the same buckets are merged by adding their
+    counts, so they can be kept for small parts of the data and combined when
+    a query asks for them.
+    '''
+
+    def __init__(self, buckets_per_decade=40, min_value=1, max_value=1e8,
+                 bucket_counts=None):
+        '''
+        Initialize LogHistogram object.
+
+        Parameters
+
+            buckets_per_decade: Number of buckets between a value and ten times
+                                that value. More buckets give more accurate
+                                percentiles.
+
+            min_value: Lower bound of the first bucket. Smaller values are
+                       counted in the underflow bucket.
+
+            max_value: Values from about this one up are counted in the
+                       overflow bucket.
+
+            bucket_counts: Optional array of counts for every bucket, e.g. the
+                           sum of the counts of several histograms with the
+                           same buckets. By default every count is 0.
+        '''
+        if buckets_per_decade < 1 or not 0 < min_value < max_value:
+            raise ValueError("buckets_per_decade must be at least 1 and "
+                             "min_value between 0 and max_value")
+
+        self.buckets_per_decade = buckets_per_decade
+        self.min_value = min_value
+        self.max_value = max_value
+        self.num_buckets = int(np.ceil(np.log10(max_value / min_value) *
+                                       buckets_per_decade)) + 2
+        if bucket_counts is None:
+            bucket_counts = np.zeros(self.num_buckets, dtype='int64')
+        elif len(bucket_counts) != self.num_buckets:
+            raise ValueError("Expected {} bucket counts".format(
+                    self.num_buckets))
+        self.bucket_counts = np.asarray(bucket_counts, dtype='int64')
+
+    @property
+    def relative_error(self):
+        '''
+        Largest error of an estimated percentile, relative to the true value,
+        for values between min_value and max_value.
+        '''
+        return 10 ** (0.5 / self.buckets_per_decade) - 1
+
+    @property
+    def total(self):
+        '''
+        Number of values counted.
+        '''
+        return int(self.bucket_counts.sum())
+
+    def buckets(self, values):
+        '''
+        Return the bucket number of each of an array of values. Values that
+        aren't positive go to the underflow bucket, 0. Missing values should
+        be dropped first.
+        '''
+        values = np.asarray(values, dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            buckets = np.floor(np.log10(values / self.min_value) *
+                               self.buckets_per_decade) + 1
+        buckets = np.nan_to_num(buckets, nan=0, neginf=0)
+        return np.clip(buckets, 0, self.num_buckets - 1).astype('int64')
+
+    def bucket_middles(self):
+        '''
+        Return the value that stands for each bucket: its geometric middle,
+        or min_value and the lower bound of the overflow bucket for the
+        underflow and overflow buckets.
+        '''
+        exponents = ((np.arange(self.num_buckets) - 0.5) /
+                     self.buckets_per_decade)
+        middles = self.min_value * 10 ** exponents
+        middles[0] = self.min_value
+        middles[-1] = self.min_value * 10 ** ((self.num_buckets - 2) /
+                                              self.buckets_per_decade)
+        return middles
+
+    def update(self, values):
+        '''
+        Add an array of values to the histogram. Missing values are skipped.
+        '''
+        values = np.asarray(values, dtype='float64')
+        self.bucket_counts += np.bincount(
+                self.buckets(values[~np.isnan(values)]),
+                minlength=self.num_buckets)
+
+    def merge(self, *others):
+        '''
+        Add the values counted by other LogHistogram objects with the same
+        buckets to this one. The result is the same as a histogram of all
+        values built at once.
+        '''
+        for other in others:
+            if ((other.buckets_per_decade, other.min_value, other.max_value)
+                    != (self.buckets_per_decade, self.min_value,
+                        self.max_value)):
+                raise ValueError("Only histograms with the same buckets can "
+                                 "be merged")
+            self.bucket_counts += other.bucket_counts
+
+    def percentiles(self, percentiles):
+        '''
+        Return an array with the estimated value at each of the given
+        percentiles, between 0 and 100 as for numpy.percentile. Every
+        estimate is NaN if the histogram is empty.
+        '''
+        percentiles = np.asarray(percentiles, dtype='float64')
+        total = self.total
+        if not total:
+            return np.full(percentiles.shape, np.nan)
+
+        # The bucket holding the value of each rank, counting from 0
+        ranks = percentiles / 100 * (total - 1)
+        buckets = np.searchsorted(np.cumsum(self.bucket_counts), ranks,
+                                  side='right')
+        return self.bucket_middles()[buckets]
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+#   synthetic_data.py - writes synthetic bike share csv files with the same
+#   columns as the project data, for benchmarks and for running the program
+#   without the real datasets.
+#
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# Number of stations and share of trips by subscribers for each city, roughly
+# as in the real data
+city_profiles = {
+    'Chicago': {'stations': 580, 'subscribers': 0.76, 'demographics': True},
+    'New York City': {'stations': 640, 'subscribers': 0.89,
+                      'demographics': True},
+    'Washington': {'stations': 480, 'subscribers': 0.73,
+                   'demographics': False},
+}
+
+_streets = ['Broadway', 'Clark', 'State', 'Halsted', 'Ashland', 'Western',
+            'Madison', 'Lake', 'Division', 'Chicago', 'Grand', 'Fullerton',
+            'Belmont', 'Irving Park', 'Lincoln', 'Wells', 'Canal', 'Jackson',
+            'Monroe', 'Adams', 'Washington', 'Randolph', 'Wacker', 'Dearborn',
+            'Franklin', 'Orleans', 'Sedgwick', 'Larrabee', 'Racine', 'Morgan',
+            'Columbus', 'Amsterdam', 'Lexington', 'Park', 'Hudson',
+            'Greenwich', 'Bleecker', 'Houston', 'Delancey', 'Pennsylvania',
+            'Massachusetts', 'Connecticut', 'Wisconsin', 'Rhode Island',
+            'Vermont', 'New Hampshire', 'Florida', 'Georgia', 'Maryland']
+_suffixes = ['St', 'Ave', 'Blvd', 'Pl', 'Dr', 'Rd']
+
+# Share of trips in each month from January to June; ridership grows as the
+# weather gets warmer
+_month_weights = np.array([0.07, 0.08, 0.12, 0.18, 0.25, 0.30])
+
+# Share of trips on each weekday, Monday first
+_weekday_weights = np.array([1.0, 1.05, 1.05, 1.05, 1.0, 0.8, 0.75])
+
+# Share of trips starting in each hour on workdays (commuting peaks in the
+# morning and late afternoon) and on weekends (one broad afternoon peak)
+_workday_hours = np.array([0.3, 0.15, 0.1, 0.05, 0.1, 0.5, 1.8, 4.5, 7.5, 4.5,
+                           3.0, 3.3, 3.9, 3.9, 3.6, 4.2, 6.9, 9.6, 7.2, 4.8,
+                           3.3, 2.4, 1.5, 0.9])
+_weekend_hours = np.array([1.2, 0.9, 0.6, 0.3, 0.2, 0.3, 0.6, 1.2, 2.4, 3.9,
+                           5.4, 6.6, 7.2, 7.5, 7.5, 7.2, 6.9, 6.3, 5.4, 4.2,
+                           3.3, 2.4, 1.8, 1.5])
+
+
+def station_names(num_stations, seed=0):
+    '''
+    Return a list of distinct station names made up of street intersections,
+    e.g. 'Clark St & Lake Ave'.
+    '''
+    rng = np.random.default_rng(seed)
+    names = set()
+    while len(names) < num_stations:
+        first, second = rng.choice(len(_streets), 2, replace=False)
+        names.add('{} {} & {} {}'.format(_streets[first],
+                                          rng.choice(_suffixes),
+                                          _streets[second],
+                                          rng.choice(_suffixes)))
+    return sorted(names)
+
+
+def _day_weights():
+    '''
+    Helper function to get the probability of a trip starting on each day of
+    the first half of 2017.
+    '''
+    days = np.arange('2017-01-01', '2017-07-01', dtype='datetime64[D]')
+    months = days.astype('datetime64[M]').astype('int64') % 12
+    weekdays = (days.astype('int64') + 3) % 7
+    days_in_month = np.bincount(months)
+
+    weights = (_month_weights[months] / days_in_month[months] *
+               _weekday_weights[weekdays])
+    return days, weekdays, weights / weights.sum()
+
+
+def _random_trips(rng, num_rows, stations, profile):
+    '''
+    Helper function to build a dataframe of random trips in the layout of the
+    project csv files.
+    '''
+    num_stations = len(stations)
+
+    # Start times: day by season and weekday, hour by the daily profile of
+    # workdays or weekends, minutes and seconds uniform
+    days, day_weekdays, day_weights = _day_weights()
+    day = rng.choice(len(days), num_rows, p=day_weights)
+    weekend = day_weekdays[day] >= 5
+    hours = np.empty(num_rows, dtype='int64')
+    for is_weekend, hour_weights in [(False, _workday_hours),
+                                     (True, _weekend_hours)]:
+        rows = weekend == is_weekend
+        hours[rows] = rng.choice(24, rows.sum(),
+                                 p=hour_weights / hour_weights.sum())
+    start = (days[day].astype('datetime64[s]') +
+             (hours * 3600 + rng.integers(0, 3600, num_rows)))
+
+    # Station popularity follows a power law: a few downtown stations see
+    # most of the trips. Most trips end close to where they started.
+    popularity = 1.0 / np.arange(1, num_stations + 1) ** 0.9
+    rank_to_station = rng.permutation(num_stations)
+    start_station = rank_to_station[rng.choice(
+            num_stations, num_rows, p=popularity / popularity.sum())]
+    nearby = start_station + rng.integers(-15, 16, num_rows)
+    end_station = np.where(rng.random(num_rows) < 0.7,
+                           nearby % num_stations,
+                           rank_to_station[rng.choice(
+                               num_stations, num_rows,
+                               p=popularity / popularity.sum())])
+    round_trip = rng.random(num_rows) < 0.01
+    end_station[round_trip] = start_station[round_trip]
+
+    # Customers ride longer than subscribers; durations are log-normal
+    subscriber = rng.random(num_rows) < profile['subscribers']
+    duration = np.where(subscriber,
+                        rng.lognormal(6.4, 0.6, num_rows),
+                        rng.lognormal(7.3, 0.8, num_rows))
+    duration = np.clip(duration, 60, 86400).round().astype('int64')
+    end = start + duration
+
+    stations = np.asarray(stations, dtype=object)
+    trips = {
+        'Start Time': np.char.replace(np.datetime_as_string(start), 'T', ' '),
+        'End Time': np.char.replace(np.datetime_as_string(end), 'T', ' '),
+        'Trip Duration': duration,
+        'Start Station': stations[start_station],
+        'End Station': stations[end_station],
+        'User Type': np.where(subscriber, 'Subscriber', 'Customer'),
+    }
+
+    # Gender and birth year are mostly recorded for subscribers only
+    if profile['demographics']:
+        gender = np.where(rng.random(num_rows) < 0.75, 'Male', 'Female')
+        # Riders are at least 16 with ages skewed towards the late twenties
+        age = 16 + np.floor(rng.gamma(3.0, 5.0, num_rows))
+        birth_year = np.maximum(2017 - age, 1900)
+        unknown = np.where(subscriber, rng.random(num_rows) < 0.02,
+                           rng.random(num_rows) < 0.9)
+        trips['Gender'] = np.where(unknown, '', gender)
+        trips['Birth Year'] = np.where(unknown, np.nan, birth_year)
+
+    return pd.DataFrame(trips)
+
+
+def write_city_csv(csv_file, num_rows, city='Chicago', seed=0,
+                   chunksize=1000000):
+    '''
+    Write a csv file of random trips from the first half of 2017 with the
+    columns of the project data for a city. Large files are generated and
+    written chunksize rows at a time.
+
+    Parameters
+
+        csv_file: Path of the csv file to write.
+
+        num_rows: Number of trips.
+
+        city: One of the cities in city_profiles. Sets the number of stations
+              and the user mix, and whether Gender and Birth Year are written.
+
+        seed: Seed of the random number generator.
+
+        chunksize: Maximum number of rows generated at once.
+    '''
+    profile = city_profiles[city]
+    rng = np.random.default_rng(seed)
+    stations = station_names(profile['stations'], seed)
+
+    with open(csv_file, 'w', newline='') as f:
+        for first_row in range(0, num_rows, chunksize):
+            trips = _random_trips(rng, min(chunksize, num_rows - first_row),
+                                  stations, profile)
+            trips.index += first_row
+            trips.to_csv(f, header=first_row == 0)
+
+
+def write_city_csvs(out_dir, num_rows, cities=None, seed=0):
+    '''
+    Write one csv file per city to a directory, named the way CsvData
+    expects, e.g. new_york_city.csv. Returns the paths of the files.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    csv_files = []
+    for i, city in enumerate(cities or city_profiles):
+        csv_file = os.path.join(out_dir,
+                                city.lower().replace(' ', '_') + '.csv')
+        write_city_csv(csv_file, num_rows, city, seed + i)
+        csv_files.append(csv_file)
+    return csv_files
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Write synthetic bike share csv files.")
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="trips per city")
+    parser.add_argument('--out-dir', default='.',
+                        help="directory the csv files are written to")
+    parser.add_argument('--cities', nargs='+', choices=list(city_profiles),
+                        metavar='CITY',
+                        help="cities to generate (default: all three)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the random number generator")
+    args = parser.parse_args()
+
+    for csv_file in write_city_csvs(args.out_dir, args.rows, args.cities,
+                                    args.seed):
+        print("Wrote {:,} rows to {}".format(args.rows, csv_file))
+
+
+if __name__ == '__main__':
+    main()
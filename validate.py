@@ -2,6 +2,8 @@
 #   Validate.py - Contains the Validate class that handles data validation.
 #
 
+import re
+import datetime as dt
 import calendar as cal
 
 
@@ -9,7 +11,7 @@ class Validate:
     '''
     A class for validating data into CsvData and DataStats object methods.
     '''
-    _month_names = cal.month_name[1:7]
+    _month_names = cal.month_name[1:]
     _weekday_names = cal.day_name
 
     def __init__(self):
@@ -29,27 +31,61 @@ class Validate:
 
         Returns
 
-            city_name_user: User-entered city name.
+            city_name_user: User-entered city name, or a list of city names if
+                            several cities are to be compared.
         '''
         while True:
             print("\nWould you like to see data for Chicago, New York or",
-                    "Washington?")
-            city_name_user = input("> ").lower()
+                    "Washington? To compare cities, enter several names",
+                    "separated by commas, or all.")
+            city_name = self.match_cities(input("> "), city_names)
 
-            for city_name in city_names:
-                if city_name_user == city_name.lower().replace(' city', ''):
-                    return city_name
+            if city_name:
+                return city_name[0] if len(city_name) == 1 else city_name
 
             print("That doesn't seem to be correct. Try again.")
 
+    def match_city(self, city_name_user, city_names):
+        '''
+        Return the city name that matches the user entered city name, or None
+        if there is no match.
+        '''
+        for city_name in city_names:
+            city_name_variants = [city_name.lower().replace(' city', ''),
+                                  city_name.lower()]
+            if city_name_user.strip().lower() in city_name_variants:
+                return city_name
+
+        return None
+
+    def match_cities(self, city_names_user, city_names):
+        '''
+        Return a list of the city names that match user entered city names,
+        separated by commas or "and", or every city name for "all". Returns
+        None if any of the names doesn't match.
+        '''
+        if city_names_user.strip().lower() == 'all':
+            return list(city_names)
+
+        matched_names = []
+        for city_name_user in re.split(r',|\band\b', city_names_user,
+                                       flags=re.IGNORECASE):
+            city_name = self.match_city(city_name_user, city_names)
+            if not city_name:
+                return None
+            if city_name not in matched_names:
+                matched_names.append(city_name)
+
+        return matched_names
+
     def get_filter_mode(self):
         '''
         Make sure user entered filter mode matches one of the available filter
         modes.
         '''
         while True:
-            print("\nHow would you like to filter the data? By month, day, or",
-                    "not at all? Enter None to forgo filtering.")
+            print("\nHow would you like to filter the data? By month, day,",
+                    "dates, or not at all? Enter None to forgo filtering.")
             filter_mode_user = input("> ").lower()
 
             if filter_mode_user == "month":
@@ -58,6 +94,9 @@ class Validate:
             elif filter_mode_user == "day":
                 self._filter_mode = 'd'
                 return 'd'
+            elif filter_mode_user in ["dates", "date range"]:
+                self._filter_mode = 'r'
+                return 'r'
             elif filter_mode_user == "none":
                 self._filter_mode = None
                 return None
@@ -69,18 +108,28 @@ class Validate:
         Helper method to get month component for filter.
         '''
         while True:
-            print("\nWhich month? January, Februrary, March, April, May",
-                    "or June?")
-            month_name_user = input("> ").lower()
+            print("\nWhich month? January, February, March, and so on",
+                    "through December.")
+            month_name = self.match_month(input("> "))
 
-            for month_name in self._month_names:
-                month_name_variants = [month_name[:3].lower(),
-                                       month_name.lower()]
-                if month_name_user in month_name_variants:
-                    return month_name
+            if month_name:
+                return month_name
 
             print("That doesn't seem correct. Try again.")
 
+    def match_month(self, month_name_user):
+        '''
+        Return the month name that matches the user entered month name or
+        abbreviation, or None if there is no match.
+        '''
+        for month_name in self._month_names:
+            month_name_variants = [month_name[:3].lower(),
+                                   month_name.lower()]
+            if month_name_user.strip().lower() in month_name_variants:
+                return month_name
+
+        return None
+
     def _get_day_component(self):
         '''
         Helper method to get day component for filter.
@@ -88,22 +137,109 @@ class Validate:
         while True:
             print("\nWhich day? Monday, Tuesday, Wednesday, Thursday, Friday,",
                     "Saturday, or Sunday?")
-            day_name_user = input("> ").lower()
+            day_name = self.match_day(input("> "))
+
+            if day_name:
+                return day_name
+
+            print("That doesn't seem correct. Try again.")
+
+    def match_day(self, day_name_user):
+        '''
+        Return the weekday name that matches the user entered day name or
+        abbreviation, or None if there is no match.
+        '''
+        for day_name in self._weekday_names:
+            day_name_variants = [day_name[:3].lower(),
+                                 day_name[:4].lower(),
+                                 day_name.lower()]
+            if day_name_user.strip().lower() in day_name_variants:
+                return day_name
+
+        return None
+
+    def _get_date_range_component(self):
+        '''
+        Helper method to get date range component for filter.
+        '''
+        while True:
+            print("\nWhich dates? Enter the first and last day, e.g.",
+                    "2017-07-01 to 2017-07-04, or a single day.")
+            date_range = self.match_date_range(input("> "))
 
-            for day_name in self._weekday_names:
-                day_name_variants = [day_name[:3].lower(),
-                                     day_name[:4].lower(),
-                                     day_name.lower()]
-                if day_name_user in day_name_variants:
-                    return day_name
+            if date_range:
+                return date_range
 
             print("That doesn't seem correct. Try again.")
 
+    def match_date_range(self, date_range_user):
+        '''
+        Return a list with the first and last day (YYYY-MM-DD) of the user
+        entered date range, or None if it isn't a valid range. The days may be
+        separated by spaces, a comma or 'to'; a single day is a range of one
+        day.
+        '''
+        days = [day for day in re.split(r'\s*,\s*|\s+to\s+|\s+',
+                                        date_range_user.strip().lower())
+                if day]
+        if len(days) not in [1, 2]:
+            return None
+
+        try:
+            days = [dt.date.fromisoformat(day) for day in days]
+        except ValueError:
+            return None
+
+        if days[0] > days[-1]:
+            return None
+
+        return [days[0].isoformat(), days[-1].isoformat()]
+
+    def get_hour_range(self):
+        '''
+        Ask the user for an optional range of start hours. Returns the first
+        hour and the stop hour (exclusive), or None for all hours.
+        '''
+        while True:
+            print("\nWhich hours? Enter a range such as 7-10 for trips",
+                    "starting from 7:00 until 9:59, or press Enter for all",
+                    "hours.")
+            hour_range_user = input("> ")
+            if not hour_range_user.strip():
+                return None
+
+            hours = self.match_hour_range(hour_range_user)
+            if hours:
+                return hours
+
+            print("That doesn't seem correct. Try again.")
+
+    def match_hour_range(self, hour_range_user):
+        '''
+        Return a list with the first hour and the stop hour (exclusive) of the
+        user entered hour range, e.g. [7, 10] for '7-10' or '7 to 10', or None
+        if it isn't a valid range. A stop hour before the first hour wraps
+        around midnight.
+        '''
+        match = re.fullmatch(r'(\d{1,2})\s*(?:-|to)\s*(\d{1,2})',
+                             hour_range_user.strip().lower())
+        if not match:
+            return None
+
+        first_hour, stop_hour = int(match.group(1)), int(match.group(2))
+        if first_hour > 23 or stop_hour > 24 or first_hour == stop_hour:
+            return None
+
+        return [first_hour, stop_hour]
+
     def get_filter_components(self):
         '''
-        Get the month and day depending on the filter mode.
+        Get the month and day, or the date range, depending on the filter
+        mode.
         '''
-        if self._filter_mode:
+        if self._filter_mode == 'r':
+            return self._get_date_range_component()
+        elif self._filter_mode:
             month_name_user = self._get_month_component()
             if self._filter_mode == 'd':
                 day_name_user = self._get_day_component()